@@ -5,32 +5,50 @@
 """
 
 import os
+import platform
 import time
 import threading
 from flask import Flask, render_template, Response, jsonify, request
 import cv2
+import numpy as np
 import io
+import queue
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import serial
-from command import SyringePumpController
+from command import SyringePumpController, xor_checksum
 
 # Raspberry Pi専用ライブラリのインポート（PCでは利用不可）
 try:
-    from picamera2 import Picamera2
+    from picamera2 import Picamera2, MappedArray
     from picamera2.encoders import JpegEncoder
     from picamera2.outputs import FileOutput
     PICAMERA_AVAILABLE = True
+    # V4L2 M2M（bcm2835-codec）を使うハードウェアMJPEGエンコーダ（古いPicamera2には無い）
+    try:
+        from picamera2.encoders import MJPEGEncoder
+    except ImportError:
+        MJPEGEncoder = None
+    # /video_feed.mp4 用のハードウェアH.264エンコーダ
+    try:
+        from picamera2.encoders import H264Encoder
+        from picamera2.outputs import Output
+    except ImportError:
+        H264Encoder = None
+        Output = object
     print("Picamera2ライブラリが利用可能です（Raspberry Pi環境）")
 except ImportError:
     PICAMERA_AVAILABLE = False
+    H264Encoder = None
+    Output = object
     print("Picamera2ライブラリが利用できません。OpenCVのVideoCaptureを使用します。")
     
     # ラズパイ環境かどうかを判定
-    import platform
     if platform.system() == "Linux" and "raspberry" in platform.machine().lower():
         print("ラズパイ環境を検出しました。OpenCVでカメラにアクセスを試行します。")
         # ラズパイで利用可能なカメラデバイスを確認
         try:
-            import os
             video_devices = [f for f in os.listdir('/dev') if f.startswith('video')]
             if video_devices:
                 print(f"利用可能なビデオデバイス: {video_devices}")
@@ -44,25 +62,99 @@ except ImportError:
         except Exception as e:
             print(f"ビデオデバイス確認エラー: {e}")
 
+# libyuv（NEON最適化された色変換ライブラリ）があれば YUV420→BGR 変換に使用
+try:
+    import ctypes
+    import ctypes.util
+    _libyuv_path = ctypes.util.find_library('yuv')
+    libyuv = ctypes.CDLL(_libyuv_path) if _libyuv_path else None
+    if libyuv is not None:
+        # libyuv の "RGB24" はメモリ上 B,G,R 順（OpenCV の BGR と同じ）
+        libyuv.I420ToRGB24.argtypes = [ctypes.c_void_p, ctypes.c_int,
+                                       ctypes.c_void_p, ctypes.c_int,
+                                       ctypes.c_void_p, ctypes.c_int,
+                                       ctypes.c_void_p, ctypes.c_int,
+                                       ctypes.c_int, ctypes.c_int]
+        print(f"libyuv を使用します: {_libyuv_path}")
+except (OSError, AttributeError) as e:
+    print(f"libyuv が利用できません。OpenCV で色変換します: {e}")
+    libyuv = None
+
+# PyTurboJPEG（libjpeg-turbo の直接呼び出し）があればソフトウェアJPEGエンコードに使用
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+    turbo_jpeg = TurboJPEG()
+    print("TurboJPEG を使用します")
+except (ImportError, OSError, RuntimeError) as e:
+    print(f"TurboJPEG が利用できません。cv2.imencode を使用します: {e}")
+    turbo_jpeg = None
+
+# nvJPEG（CUDA GPU による JPEG エンコード）があれば最優先で使用（開発PC / Jetson 向け）
+try:
+    from nvjpeg import NvJpeg
+    gpu_jpeg = NvJpeg()
+    print("nvJPEG（GPU）を使用します")
+except ImportError:
+    # nvjpeg 未インストール（ラズパイでは通常これ）
+    gpu_jpeg = None
+except Exception as e:
+    # インストール済みでも CUDA ランタイムの不備などで初期化に失敗する場合がある
+    print(f"nvJPEG を初期化できません。CPU でエンコードします: {e}")
+    gpu_jpeg = None
+
+# orjson（C拡張の高速JSONシリアライザ）があれば jsonify に使用
+try:
+    import orjson
+    from flask.json.provider import DefaultJSONProvider
+
+    class OrjsonProvider(DefaultJSONProvider):
+        """jsonify / app.json を orjson で処理する JSON プロバイダ"""
+
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj).decode('utf-8')
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+        def response(self, *args, **kwargs):
+            # bytes のまま Response に渡し、str への往復変換を省く
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(orjson.dumps(obj), mimetype=self.mimetype)
+except ImportError:
+    OrjsonProvider = None
+
 app = Flask(__name__)
+if OrjsonProvider is not None:
+    app.json = OrjsonProvider(app)
 
 # カメラ設定
 camera = None
 camera_initialized = False
-stream_thread = None
-frame_buffer = None
-frame_lock = threading.Lock()
 is_raspberry_pi = False
 
 # --- 追加: 動的設定用のグローバル変数 ---
 CAM_WIDTH = 640
 CAM_HEIGHT = 480
 CAM_FPS = 45
+# Picamera2 のバッファ数（HTTP処理やGILによる遅延を吸収してフレーム落ちを防ぐ）
+CAM_BUFFER_COUNT = 6
+# ?size=small のスナップショットの解像度と品質（Picamera2 では lores ストリームから取得）
+SNAPSHOT_SMALL_SIZE = (320, 240)
+SNAPSHOT_SMALL_QUALITY = 75
+# Picamera2 の main ストリームのピクセルフォーマット（initialize_camera で決定）
+camera_format = "RGB888"
 
 # OS判定
-import platform
 IS_WINDOWS = platform.system() == "Windows"
 
+# OpenCV VideoCapture のバックエンド（V4L2 / DirectShow はバッファ数と FOURCC の指定が効く）
+if IS_WINDOWS:
+    CAPTURE_BACKEND = cv2.CAP_DSHOW
+elif platform.system() == "Linux":
+    CAPTURE_BACKEND = cv2.CAP_V4L2
+else:
+    CAPTURE_BACKEND = cv2.CAP_ANY
+
 # シリアル通信設定（ハイセラポンプ制御用）
 if IS_WINDOWS:
     SERIAL_PORT_1 = "COM18"  # Windows環境の場合（ハイセラポンプ1-3用）
@@ -72,8 +164,13 @@ else:
     SERIAL_PORT_2 = "/dev/ttyACM1"  # Linux/Raspberry Pi環境の場合（ハイセラポンプ4-6用）
 
 BAUD_RATE = 9600
+# 書き込みタイムアウト（11バイトは 9600bps で約12ms。相手が受け取らない時にロックを握ったまま固まらないように）
+SERIAL_WRITE_TIMEOUT = 0.5
 ser_1 = None  # ポンプ1-3用
 ser_2 = None  # ポンプ4-6用
+# 送信と応答受信を1組として直列化するためのポート毎のロック（送信関数内で再取得するため RLock）
+ser_lock_1 = threading.RLock()
+ser_lock_2 = threading.RLock()
 serial_initialized1 = False # ポンプ1-3用シリアル通信初期化フラグ
 serial_initialized2 = False # ポンプ4-6用シリアル通信初期化フラグ
 
@@ -85,23 +182,32 @@ else:
 
 SYRINGE_BAUD_RATE = 9600
 ser_syringe = None
+ser_syringe_lock = threading.Lock()
 syringe_serial_initialized = False
 syringe_pump_controllers = []  # シリンジポンプ制御インスタンスのリスト
+SYRINGE_PUMP_MAX = 32  # API で受け付けるポンプ番号の上限
+# シリアル未初期化時や7番以降のポンプ用（リクエスト毎に生成せず使い回す）
+_fallback_syringe_controllers = {
+    i: SyringePumpController(i, None, ser_syringe_lock) for i in range(1, SYRINGE_PUMP_MAX + 1)
+}
 
-def initialize_serial():
-    """シリアル通信を初期化（ハイセラポンプ）"""
+def initialize_serial(port_1=None, port_2=None):
+    """シリアル通信を初期化（ハイセラポンプ）。ポート指定が無ければ既定値を使う"""
     global ser_1, ser_2, serial_initialized_1, serial_initialized_2
     
+    port_1 = port_1 or SERIAL_PORT_1
+    port_2 = port_2 or SERIAL_PORT_2
+    
     print(f"OS: {platform.system()}")
     print(f"シリアルポート設定:")
-    print(f"  ポンプ1-3用: {SERIAL_PORT_1}")
-    print(f"  ポンプ4-6用: {SERIAL_PORT_2}")
+    print(f"  ポンプ1-3用: {port_1}")
+    print(f"  ポンプ4-6用: {port_2}")
     
     try:
         # ポンプ1-3用ポートの初期化
-        print(f"ポート {SERIAL_PORT_1} を開こうとしています...")
-        ser_1 = serial.Serial(SERIAL_PORT_1, BAUD_RATE, timeout=1)
-        print(f"✓ ハイセラポンプ1-3用シリアル通信が正常に初期化されました: {SERIAL_PORT_1}")
+        print(f"ポート {port_1} を開こうとしています...")
+        ser_1 = serial.Serial(port_1, BAUD_RATE, timeout=1, write_timeout=SERIAL_WRITE_TIMEOUT)
+        print(f"✓ ハイセラポンプ1-3用シリアル通信が正常に初期化されました: {port_1}")
         serial_initialized_1 = True
     except Exception as e:
         print(f"✗ ハイセラポンプ1-3用シリアル通信初期化エラー: {e}")
@@ -112,9 +218,9 @@ def initialize_serial():
 
     try:
         # ポンプ4-6用ポートの初期化
-        print(f"ポート {SERIAL_PORT_2} を開こうとしています...")
-        ser_2 = serial.Serial(SERIAL_PORT_2, BAUD_RATE, timeout=1)
-        print(f"✓ ハイセラポンプ4-6用シリアル通信が正常に初期化されました: {SERIAL_PORT_2}")
+        print(f"ポート {port_2} を開こうとしています...")
+        ser_2 = serial.Serial(port_2, BAUD_RATE, timeout=1, write_timeout=SERIAL_WRITE_TIMEOUT)
+        print(f"✓ ハイセラポンプ4-6用シリアル通信が正常に初期化されました: {port_2}")
         serial_initialized_2 = True
     except Exception as e:
         print(f"✗ ハイセラポンプ4-6用シリアル通信初期化エラー: {e}")
@@ -126,23 +232,27 @@ def initialize_serial():
     # 両方の初期化結果を返す
     return serial_initialized_1 or serial_initialized_2    
 
-def initialize_syringe_serial():
-    """シリアル通信を初期化（シリンジポンプ）"""
+def initialize_syringe_serial(port=None):
+    """シリアル通信を初期化（シリンジポンプ）。ポート指定が無ければ既定値を使う"""
     global ser_syringe, syringe_serial_initialized, syringe_pump_controllers
     
-    print(f"シリンジポンプ用ポート: {SYRINGE_SERIAL_PORT}")
+    port = port or SYRINGE_SERIAL_PORT
+    
+    print(f"シリンジポンプ用ポート: {port}")
     
     try:
-        ser_syringe = serial.Serial(SYRINGE_SERIAL_PORT, SYRINGE_BAUD_RATE, timeout=1)
+        ser_syringe = serial.Serial(port, SYRINGE_BAUD_RATE, timeout=1, write_timeout=SERIAL_WRITE_TIMEOUT)
         syringe_serial_initialized = True
         
         # 6個のポンプ制御インスタンスを作成
         syringe_pump_controllers.clear()
         for i in range(1, 7):
-            controller = SyringePumpController(i, ser_syringe)
+            controller = SyringePumpController(i, ser_syringe, ser_syringe_lock)
             syringe_pump_controllers.append(controller)
+        for controller in _fallback_syringe_controllers.values():
+            controller.serial_port = ser_syringe
         
-        print(f"✓ シリンジポンプ用シリアル通信が正常に初期化されました: {SYRINGE_SERIAL_PORT}")
+        print(f"✓ シリンジポンプ用シリアル通信が正常に初期化されました: {port}")
         print(f"✓ 6個のポンプ制御インスタンスを作成しました")
         return True
     except Exception as e:
@@ -154,109 +264,194 @@ def initialize_syringe_serial():
         return False
 
 def calc_checksum(data_bytes):
-    """チェックサムを計算"""
-    checksum = 0
-    for b in data_bytes[1:9]:
-        checksum ^= b
-    return checksum
+    """チェックサムを計算（1～8バイト目のXOR）"""
+    return xor_checksum(data_bytes[1:9])
 
-def send_serial_command(pump_no, action, value="000000"):
-    """シリアルコマンドを送信"""
-    if (pump_no < 4) and (not serial_initialized_1):
+# (コマンド番号, 動作) ごとの固定部分（STX + 番号 + 動作）とそのXORのキャッシュ
+_pump_command_templates = {}
+
+def get_pump_command_template(command_pump_no, action):
+    """コマンドの固定部分とチェックサム途中値を返す（不正な組み合わせは None）"""
+    key = (command_pump_no, action)
+    template = _pump_command_templates.get(key)
+    if template is None:
+        try:
+            head = f"{command_pump_no}{action}".encode('ascii')
+        except UnicodeEncodeError:
+            return None
+        if len(head) != 2:
+            return None
+        template = (b'\x02' + head, head[0] ^ head[1])
+        _pump_command_templates[key] = template
+    return template
+
+# 値が "000000" のコマンド（電流値・回転数の問い合わせ等）は11バイト全体をキャッシュ
+_pump_query_commands = {}
+
+def build_pump_command(command_pump_no, action, value="000000"):
+    """11バイトのポンプコマンド（STX + 番号 + 動作 + 値6桁 + CS + ETX）を生成"""
+    if value == "000000":
+        cmd = _pump_query_commands.get((command_pump_no, action))
+        if cmd is not None:
+            return cmd
+    template = get_pump_command_template(command_pump_no, action)
+    try:
+        value_bytes = value.zfill(6).encode('ascii')
+    except UnicodeEncodeError:
+        return None
+    if template is None or len(value_bytes) != 6:
+        return None
+    # 可変部分は値6桁のみ。チェックサムは固定部分のXORに値のXORを重ねる
+    head, head_xor = template
+    cmd = head + value_bytes + bytes((head_xor ^ xor_checksum(value_bytes), 0x03))
+    if value == "000000":
+        _pump_query_commands[(command_pump_no, action)] = cmd
+    return cmd
+
+# 1つのシリアルポートにつながるハイセラポンプの数（ポンプ1-3はポート1、4-6はポート2）
+PUMPS_PER_PORT = 3
+
+def pump_command_no(pump_no):
+    """ポンプ番号(1-6)をコマンド番号(1-3)に変換（4→1, 5→2, 6→3。範囲外は None）"""
+    if 1 <= pump_no <= 2 * PUMPS_PER_PORT:
+        return (pump_no - 1) % PUMPS_PER_PORT + 1
+    return None
+
+def pump_port(pump_no):
+    """ポンプ番号に対応する (シリアルポート, ロック) を返す"""
+    if pump_no <= PUMPS_PER_PORT:
+        return ser_1, ser_lock_1
+    return ser_2, ser_lock_2
+
+def write_pump_command(pump_no, cmd):
+    """生成済みの11バイトコマンドをポンプ番号に対応するシリアルポートへ送信"""
+    if (pump_no <= PUMPS_PER_PORT) and (not serial_initialized_1):
         print("シリアル通信1が初期化されていません")
         return False
-    if (pump_no > 3) and (not serial_initialized_2):
+    if (pump_no > PUMPS_PER_PORT) and (not serial_initialized_2):
         print("シリアル通信2が初期化されていません")
         return False
     
     try:
-        # ポンプ番号に応じて適切なシリアルポートを選択し、コマンド番号を変換
-        if 1 <= pump_no <= 3:
-            target_ser = ser_1
-            port_name = f"COM1-3({SERIAL_PORT_1})"
-            command_pump_no = pump_no  # そのまま
-        elif 4 <= pump_no <= 6:
-            target_ser = ser_2
-            port_name = f"COM4-6({SERIAL_PORT_2})"
-            command_pump_no = pump_no - 3  # 4→1, 5→2, 6→3
-        else:
-            print(f"無効なポンプ番号: {pump_no}")
-            return False
-        
-        value_str = value.zfill(6)
-        cmd = bytearray(11)
-        cmd[0] = 0x02
-        cmd[1] = ord(str(command_pump_no))  # 変換されたコマンド番号を使用
-        cmd[2] = ord(action)
-        for i, c in enumerate(value_str):
-            cmd[3 + i] = ord(c)
-        cmd[9] = calc_checksum(cmd)
-        cmd[10] = 0x03
-        
-        target_ser.write(cmd)
-        print(f"[Pump {pump_no}] {port_name} に送信: {' '.join(f'{b:02X}' for b in cmd)} (コマンド番号: {command_pump_no})")
+        # ポンプ番号に応じて適切なシリアルポートを選択
+        target_ser, target_lock = pump_port(pump_no)
+        with target_lock:
+            target_ser.write(cmd)
+        port_name = f"COM1-3({SERIAL_PORT_1})" if pump_no <= PUMPS_PER_PORT else f"COM4-6({SERIAL_PORT_2})"
+        print(f"[Pump {pump_no}] {port_name} に送信: {cmd.hex(' ').upper()} (コマンド番号: {cmd[1] - 0x30})")
         return True
     except Exception as e:
         print(f"シリアル送信エラー: {e}")
         return False
 
+def send_serial_command(pump_no, action, value="000000"):
+    """シリアルコマンドを生成して送信"""
+    command_pump_no = pump_command_no(pump_no)
+    if command_pump_no is None:
+        print(f"無効なポンプ番号: {pump_no}")
+        return False
+    cmd = build_pump_command(command_pump_no, action, value)
+    if cmd is None:
+        print(f"無効なコマンド: action={action}, value={value}")
+        return False
+    return write_pump_command(pump_no, cmd)
+
+def create_jpeg_encoder():
+    """Picamera2 用の JPEG エンコーダを生成（ハードウェア MJPEGEncoder を優先）"""
+    if MJPEGEncoder is not None:
+        try:
+            # /dev/video11 等の V4L2 M2M エンコーダで圧縮するため CPU をほぼ使わない
+            return MJPEGEncoder()
+        except Exception as e:
+            print(f"ハードウェアMJPEGエンコーダ初期化失敗、ソフトウェアJPEGにフォールバック: {e}")
+    # JpegEncoder の引数名はバージョンにより差異があるため双方を試す
+    try:
+        return JpegEncoder(quality=85)
+    except TypeError:
+        return JpegEncoder(q=85)
+
+def create_camera_config():
+    """現在の CAM_* 設定と camera_format から Picamera2 の設定を生成"""
+    # エンコーダで連続出力する場合は録画向けの video 設定（ノイズ除去が軽量）を使う
+    create = camera.create_video_configuration if jpeg_encoder else camera.create_preview_configuration
+    streams = {}
+    if CAM_WIDTH > SNAPSHOT_SMALL_SIZE[0] and CAM_HEIGHT > SNAPSHOT_SMALL_SIZE[1]:
+        # ?size=small のスナップショット用に ISP で縮小した lores ストリームも出力
+        streams["lores"] = {"size": SNAPSHOT_SMALL_SIZE, "format": "YUV420"}
+    return create(
+        main={"size": (CAM_WIDTH, CAM_HEIGHT), "format": camera_format},
+        encode="main",
+        buffer_count=CAM_BUFFER_COUNT,
+        **streams
+    )
+
+def open_video_capture(device_id):
+    """低遅延設定（ドライバのキュー1枚・MJPG）で VideoCapture を開く"""
+    capture = cv2.VideoCapture(device_id, CAPTURE_BACKEND)
+    if not capture.isOpened() and CAPTURE_BACKEND != cv2.CAP_ANY:
+        # 指定バックエンドで開けない環境では既定のバックエンドで再試行
+        capture.release()
+        capture = cv2.VideoCapture(device_id)
+    if capture.isOpened():
+        # キューに溜まった古いフレームを読まないよう、保持するバッファを1枚にする
+        capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        # カメラ側で圧縮した MJPG を要求（解像度より先に設定しないと反映されないドライバがある）
+        capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+    return capture
+
+# USB カメラの MJPG をデコード・再エンコードせずに配信しているか
+capture_passthrough = False
+
+def enable_mjpeg_passthrough(capture):
+    """read() が MJPG の圧縮データをそのまま返すよう切り替える（使えなければ元に戻して False）"""
+    try:
+        if capture.set(cv2.CAP_PROP_CONVERT_RGB, 0):
+            ret, data = capture.read()
+            if ret and data is not None and data.size > 4:
+                head = data.reshape(-1)[:2].tobytes()
+                # ハフマンテーブル（DHT）を省いた MJPG はブラウザで表示できないため対象外
+                if head == b'\xff\xd8' and data.tobytes().find(b'\xff\xc4') != -1:
+                    return True
+    except cv2.error as e:
+        print(f"MJPGパススルー確認エラー: {e}")
+    capture.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+    return False
+
 def initialize_camera():
     try:
         # jpeg_buffer 等も関数内で設定するので global 宣言を追加
-        global camera, camera_initialized, is_raspberry_pi, jpeg_buffer, jpeg_encoder, jpeg_output
+        global camera, camera_initialized, is_raspberry_pi, camera_format, jpeg_buffer, jpeg_encoder, jpeg_output
+        global capture_passthrough
+        capture_passthrough = False
         if PICAMERA_AVAILABLE:
             # Picamera2を使用（ラズパイ公式カメラモジュール用）
             print("Picamera2でカメラを初期化中...")
 
-            # カメラモジュールの状態確認
-            try:
-                import subprocess
-                result = subprocess.run(['vcgencmd', 'get_camera'],
-                                        capture_output=True, text=True, timeout=5)
-                if result.returncode == 0:
-                    print(f"カメラモジュール状態: {result.stdout.strip()}")
-                else:
-                    print("カメラモジュール状態確認に失敗")
-            except Exception as e:
-                print(f"カメラモジュール状態確認エラー: {e}")
-
-            # カメラデバイスの確認
-            try:
-                import os
-                video_devices = [f for f in os.listdir('/dev') if f.startswith('video')]
-                print(f"利用可能なビデオデバイス: {video_devices}")
-            except Exception as e:
-                print(f"ビデオデバイス確認エラー: {e}")
-
+            # カメラモジュール・デバイスの確認は system_diagnostics()（/api/system_info）で行う
             camera = Picamera2()
 
-            # カメラ設定
-            print("カメラ設定を作成中...")
-            config = camera.create_preview_configuration(
-                main={"size": (CAM_WIDTH, CAM_HEIGHT), "format": "RGB888"},
-                encode="main",
-                buffer_count=4  # バッファ数を増やす
-            )
-            print("カメラ設定を適用中...")
-            camera.configure(config)
-
             # Picamera2 のハードウェアJPEGエンコーダ準備（利用可能なら）
             try:
                 jpeg_buffer = _JpegBuffer()
-                # JpegEncoder の引数名はバージョンにより差異があるため双方を試す
-                try:
-                    jpeg_encoder = JpegEncoder(quality=85)
-                except TypeError:
-                    jpeg_encoder = JpegEncoder(q=85)
+                jpeg_encoder = create_jpeg_encoder()
                 # FileOutput に BufferedIOBase を渡す
                 jpeg_output = FileOutput(jpeg_buffer)
-                print("ハードウェアJPEGエンコーダを初期化しました")
+                print(f"JPEGエンコーダを初期化しました: {type(jpeg_encoder).__name__}")
             except Exception as e:
                 print(f"ハードウェアJPEGエンコーダ初期化失敗: {e}")
                 jpeg_buffer = None
                 jpeg_encoder = None
                 jpeg_output = None
 
+            # エンコーダがあれば YUV420（1.5バイト/画素）で取得し、JPEGエンコーダへ直接渡す
+            camera_format = "YUV420" if jpeg_encoder else "RGB888"
+
+            # カメラ設定
+            print(f"カメラ設定を作成中...（フォーマット: {camera_format}）")
+            config = create_camera_config()
+            print("カメラ設定を適用中...")
+            camera.configure(config)
+
             # Picamera2 にフレームレートを明示設定
             try:
                 camera.set_controls({"FrameRate": CAM_FPS})
@@ -284,12 +479,12 @@ def initialize_camera():
             # 成功とみなす（start() 成功ならカメラは使用可能）
             camera_initialized = True
             is_raspberry_pi = True
+            frame_broker.start()
             print("Picamera2 カメラ初期化完了（ハードウェアエンコーダ使用:" + ("有効" if started_hw else "無効") + "）")
             return True
 
         else:
             # OpenCVを使用（PCカメラまたはラズパイカメラモジュール）
-            import platform
             is_raspberry_pi_hardware = platform.system() == "Linux" and "raspberry" in platform.machine().lower()
 
             if is_raspberry_pi_hardware:
@@ -303,7 +498,7 @@ def initialize_camera():
             for device_id in camera_devices:
                 try:
                     print(f"カメラデバイス {device_id} を試行中...")
-                    camera_local = cv2.VideoCapture(device_id)
+                    camera_local = open_video_capture(device_id)
 
                     if camera_local.isOpened():
                         # カメラ設定
@@ -324,7 +519,11 @@ def initialize_camera():
                             print(f"カメラデバイス {device_id} でテストフレーム取得成功: サイズ={test_frame.shape}")
                             camera = camera_local
                             is_raspberry_pi = is_raspberry_pi_hardware
+                            capture_passthrough = enable_mjpeg_passthrough(camera_local)
+                            if capture_passthrough:
+                                print("カメラの MJPG をそのまま配信します（再エンコードなし）")
                             camera_initialized = True
+                            frame_broker.start()
                             camera_type = "ラズパイカメラモジュール" if is_raspberry_pi_hardware else "PCカメラ"
                             print(f"{camera_type}が正常に初期化されました（デバイスID: {device_id}）")
                             return True
@@ -352,8 +551,111 @@ def initialize_camera():
         camera_initialized = False
         return False
 
+# 色変換の出力先バッファ（スレッド毎に使い回し、フレーム毎の確保を避ける）
+_convert_local = threading.local()
+
+def thread_buffer(name, shape):
+    """スレッド毎に使い回すフレームバッファを返す（形が変わった時だけ確保し直す）"""
+    buf = getattr(_convert_local, name, None)
+    if buf is None or buf.shape != shape:
+        buf = np.empty(shape, dtype=np.uint8)
+        setattr(_convert_local, name, buf)
+    return buf
+
+def yuv420_to_bgr(yuv, width):
+    """YUV420(I420) 配列を BGR に変換（返す配列は同じスレッドの次回呼び出しで上書きされる）
+
+    yuv は Picamera2 のバッファそのままの (高さ*3/2, 行ストライド) 配列。ISP が行末に
+    余白を付けている場合は行ストライド > width なので、実際の幅 width を別に渡す。
+    """
+    height = yuv.shape[0] * 2 // 3
+    stride = yuv.shape[1]
+    dst = thread_buffer('bgr', (height, width, 3))
+
+    if libyuv is not None and yuv.flags['C_CONTIGUOUS']:
+        # Y は stride、U/V は stride/2 ごとに行が並ぶ。出力は width 分だけ変換する
+        y_ptr = yuv.ctypes.data
+        u_ptr = y_ptr + stride * height
+        v_ptr = u_ptr + (stride // 2) * (height // 2)
+        libyuv.I420ToRGB24(y_ptr, stride, u_ptr, stride // 2, v_ptr, stride // 2,
+                           dst.ctypes.data, width * 3, width, height)
+    elif stride == width:
+        cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR_I420, dst=dst)
+    else:
+        # 余白込みの幅で変換してから、右端の余白を除いて詰める
+        padded = thread_buffer('bgr_padded', (height, stride, 3))
+        cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR_I420, dst=padded)
+        np.copyto(dst, padded[:, :width])
+    return dst
+
+def capture_yuv_as_bgr():
+    """YUV420 の DMA バッファを capture_array() でコピーせず直接参照し、BGR に変換して返す"""
+    request = camera.capture_request()
+    try:
+        with MappedArray(request, "main") as m:
+            yuv = m.array
+            if yuv.size == 0:
+                print("ラズパイカメラから空のフレームが取得されました")
+                return None
+            # YUV420 はエンコーダ向け。OpenCV で扱う場合のみ BGR に変換する
+            # （行ストライドに余白があっても、変換時に実際の幅だけを取り出す）
+            return yuv420_to_bgr(yuv, camera.camera_config["main"]["size"][0])
+    finally:
+        request.release()
+
+def capture_rgb888():
+    """RGB888(B,G,R順) の DMA バッファを使い回しのバッファへコピーして返す（毎フレームの確保を避ける）"""
+    request = camera.capture_request()
+    try:
+        with MappedArray(request, "main") as m:
+            src = m.array
+            if src.ndim != 3 or src.shape[0] != CAM_HEIGHT or src.shape[1] != CAM_WIDTH or src.shape[2] < 3:
+                # 想定外のレイアウト（ストライド余白など）は Picamera2 に詰め直させる
+                return request.make_array("main")
+            dst = thread_buffer('rgb888', (CAM_HEIGHT, CAM_WIDTH, 3))
+            np.copyto(dst, src[:, :, :3])
+            return dst
+    finally:
+        request.release()
+
+def get_small_frame():
+    """?size=small 用の縮小フレーム（BGR）を返す（失敗時は None）"""
+    if is_raspberry_pi and PICAMERA_AVAILABLE and camera.camera_config.get("lores"):
+        # ISP が縮小済みの YUV420 なので、変換は 1/4 の画素数で済む
+        request = camera.capture_request()
+        try:
+            with MappedArray(request, "lores") as m:
+                return yuv420_to_bgr(m.array, camera.camera_config["lores"]["size"][0])
+        finally:
+            request.release()
+    frame = frame_broker.capture_raw() if frame_broker.producing() else get_frame()
+    if frame is None:
+        return None
+    return cv2.resize(frame, SNAPSHOT_SMALL_SIZE, interpolation=cv2.INTER_AREA)
+
+def decode_jpeg(jpeg_bytes):
+    """JPEG バイト列を BGR の ndarray に復号（失敗時は None）"""
+    return cv2.imdecode(np.frombuffer(jpeg_bytes, np.uint8), cv2.IMREAD_COLOR)
+
+def get_jpeg_frame():
+    """MJPG パススルー時にカメラの JPEG をそのまま bytes で返す（失敗時は None）"""
+    ret, data = camera.read()
+    if not ret or data is None or data.size == 0:
+        return None
+    return data.tobytes()
+
+def grab_frame():
+    """フレームを取り込むだけで捨てる（変換・デコードを省く）。失敗時は False"""
+    if not camera_initialized:
+        return False
+    if is_raspberry_pi and PICAMERA_AVAILABLE:
+        # リクエストを受け取ってすぐ返却する（MappedArray・色変換なし）
+        camera.capture_request().release()
+        return True
+    return camera.grab()
+
 def get_frame():
-    """カメラからフレームを取得"""
+    """カメラからフレームを取得（BGR順のndarrayを返す）"""
     global camera, camera_initialized, is_raspberry_pi
     
     if not camera_initialized:
@@ -364,7 +666,10 @@ def get_frame():
         if is_raspberry_pi and PICAMERA_AVAILABLE:
             # Raspberry Piカメラから画像をキャプチャ
             try:
-                frame = camera.capture_array()
+                if camera_format == "YUV420":
+                    return capture_yuv_as_bgr()
+
+                frame = capture_rgb888()
                 
                 if frame is None or frame.size == 0:
                     print("ラズパイカメラから空のフレームが取得されました")
@@ -375,22 +680,29 @@ def get_frame():
                     print(f"ラズパイカメラから無効なフレームサイズ: {frame.shape}")
                     return None
                 
-                # BGRからRGBに変換（OpenCVはBGR、Web表示はRGB）
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                
-                return frame_rgb
+                # "RGB888" はメモリ上 B,G,R 順なので JPEG エンコーダにそのまま渡せる（変換不要）
+                return frame
                 
             except Exception as e:
                 print(f"ラズパイカメラフレーム取得エラー: {e}")
                 return None
         else:
             # PCカメラから画像をキャプチャ
-            ret, frame = camera.read()
+            if capture_passthrough:
+                ret, frame = camera.read()
+                if ret and frame is not None:
+                    # 圧縮データのまま受け取っているので画素が必要な時だけ復号する
+                    return cv2.imdecode(frame, cv2.IMREAD_COLOR)
+                print("PCカメラからフレームが取得できませんでした")
+                return None
+
+            # 前回の出力配列を渡して再利用させる（サイズが同じなら OpenCV は確保し直さない）
+            ret, frame = camera.read(getattr(_convert_local, 'capture', None))
             
             if ret and frame is not None:
-                # BGRからRGBに変換
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                return frame_rgb
+                _convert_local.capture = frame
+                # VideoCapture は BGR で返すため、そのまま JPEG エンコードに渡す
+                return frame
             else:
                 print("PCカメラからフレームが取得できませんでした")
                 return None
@@ -399,77 +711,514 @@ def get_frame():
         print(f"フレーム取得エラー: {e}")
         return None
 
-def generate_frames():
-    """MJPEGストリーミング用のフレーム生成（ハードウェアJPEGがあれば優先使用）"""
-    global jpeg_buffer, camera, camera_initialized, is_raspberry_pi
+# ストリーミング用 JPEG 品質（配信が追いつかない時は下限まで段階的に下げる）
+STREAM_JPEG_QUALITY_MAX = 80
+STREAM_JPEG_QUALITY_MIN = 40
+STREAM_JPEG_QUALITY_STEP = 10
+# エンコード＋配信にかけてよい時間（秒）と、品質を変更するまでの連続回数
+STREAM_LAG_THRESHOLD = 0.033
+STREAM_LAG_WINDOW = 10
+# 静止画面の検出: 1/8 に縮小（画素平均）した画像で、最大の画素差がこれ未満なら
+# 前回 publish したフレームと同じとみなす（全体平均だと小さな物体の動きを見落とすため）
+STREAM_STATIC_THRESHOLD = 8
+STREAM_STATIC_SCALE = 8
+# 静止中でもこの間隔で publish する（スナップショットが直近のJPEGを使えるように）
+STREAM_STATIC_MAX_INTERVAL = 0.5
 
-    frame_count = 0
-    error_count = 0
+def encode_jpeg(frame, quality):
+    """BGR フレームを JPEG バイト列にエンコード（失敗時は None）"""
+    if gpu_jpeg is not None:
+        return gpu_jpeg.encode(frame, quality)
+    if turbo_jpeg is not None:
+        # libjpeg-turbo を直接呼び出す（エンコード中は GIL を解放）
+        # 4:2:0 サブサンプリングは既定の 4:2:2 より DCT ブロックが少なく高速
+        return turbo_jpeg.encode(frame, quality=quality, pixel_format=TJPF_BGR,
+                                 jpeg_subsample=TJSAMP_420)
+    # ハフマン最適化の2パス目を省略
+    ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality,
+                                               cv2.IMWRITE_JPEG_OPTIMIZE, 0])
+    return buffer.tobytes() if ret else None
 
-    while True:
-        try:
-            # ハードウェアエンコード経路（Picamera2 が有効でかつバッファがある場合）
-            if is_raspberry_pi and PICAMERA_AVAILABLE and jpeg_buffer is not None:
-                jpeg_bytes = jpeg_buffer.get()
-                if jpeg_bytes and len(jpeg_bytes) > 0:
-                    frame_count += 1
-                    if frame_count % 1000 == 0:
-                        print(f"ハードウェア経路で送信: {frame_count}フレーム")
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + jpeg_bytes + b'\r\n')
-                    time.sleep(1.0 / max(1, CAM_FPS))
+def hw_encoder_active():
+    """Picamera2 のエンコーダ出力（_JpegBuffer）経由でフレームが供給されているか"""
+    return is_raspberry_pi and PICAMERA_AVAILABLE and jpeg_buffer is not None
+
+# プロデューサスレッドを固定するCPU（None なら最後のコア）と nice 値
+PRODUCER_CPU = None
+PRODUCER_NICE = -5
+
+def pin_producer_thread():
+    """呼び出し元スレッドを1コアに固定し優先度を上げる（Linux のみ、失敗しても続行）"""
+    if not hasattr(os, 'sched_setaffinity'):
+        return
+    try:
+        cpus = os.sched_getaffinity(0)
+        if len(cpus) > 1:
+            # pid 0 は呼び出し元スレッドを指す。コア間移動によるキャッシュの再ウォームを避ける
+            cpu = PRODUCER_CPU if PRODUCER_CPU is not None else max(cpus)
+            os.sched_setaffinity(0, {cpu})
+            print(f"フレーム生成スレッドを CPU {cpu} に固定しました")
+    except OSError as e:
+        print(f"CPU固定に失敗しました: {e}")
+    try:
+        # 負の nice 値には CAP_SYS_NICE が必要
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), PRODUCER_NICE)
+        print(f"フレーム生成スレッドの nice 値を {PRODUCER_NICE} に設定しました")
+    except OSError as e:
+        print(f"優先度の変更に失敗しました（権限不足の可能性）: {e}")
+
+class FrameBroker:
+    """最新のJPEGフレームを全クライアントで共有する（1プロデューサ / Nコンシューマ）"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.jpeg = None
+        self.seq = 0
+        self.published_at = 0.0
+        # いずれかのクライアントが最後に受け取ったフレーム番号と時刻
+        self.consumed_seq = 0
+        self.consumed_at = 0.0
+        self.quality = STREAM_JPEG_QUALITY_MAX
+        # スナップショット用の生フレーム受け渡し（要求がある時だけコピーする）
+        self.raw = None
+        self.raw_seq = 0
+        self.raw_requests = 0
+        self.thread = None
+        # /api/status 用の統計（print せずに数えるだけ）
+        self.viewers = 0
+        self.frames_sent = 0
+
+    def publish(self, jpeg_bytes):
+        """新しいJPEGフレームを登録し、待機中のクライアントを起こす"""
+        with self.cond:
+            self.jpeg = jpeg_bytes
+            self.seq += 1
+            self.published_at = time.monotonic()
+            self.cond.notify_all()
+
+    def wait_next(self, last_seq, timeout=1.0):
+        """last_seq より新しいフレームを待つ（タイムアウト時は同じ seq を返す）"""
+        with self.cond:
+            # 待機中に破棄された古いフレーム（jpeg=None）は配信しない
+            if not self.cond.wait_for(lambda: self.seq != last_seq and self.jpeg is not None, timeout):
+                return last_seq, None
+            if self.seq != self.consumed_seq:
+                self.consumed_seq = self.seq
+                self.consumed_at = time.monotonic()
+            self.frames_sent += 1
+            return self.seq, self.jpeg
+
+    def add_viewer(self, delta):
+        """ストリーミング視聴者数を増減する"""
+        with self.cond:
+            self.viewers += delta
+            # 待機中のプロデューサを起こす
+            self.cond.notify_all()
+
+    def stats(self):
+        """配信統計（/api/status 用）"""
+        with self.cond:
+            return {
+                'viewers': self.viewers,
+                'frames_published': self.seq,
+                'frames_sent': self.frames_sent,
+                'jpeg_quality': self.quality,
+            }
+
+    def latest(self, max_age):
+        """max_age 秒以内に publish された最新JPEGを返す（無ければ None）"""
+        with self.cond:
+            if self.jpeg and time.monotonic() - self.published_at <= max_age:
+                return self.jpeg
+            return None
+
+    def producing(self):
+        """プロデューサスレッドがカメラからフレームを取得しているか"""
+        return self.thread is not None and self.thread.is_alive() and not hw_encoder_active()
+
+    def capture_raw(self, timeout=1.0):
+        """プロデューサから次の生フレーム（BGR のコピー）を受け取る（カメラの同時読み出しを避ける）"""
+        with self.cond:
+            raw_seq = self.raw_seq
+            self.raw_requests += 1
+            # 視聴者がいなくて待機中のプロデューサを起こす
+            self.cond.notify_all()
+            try:
+                if not self.cond.wait_for(lambda: self.raw_seq != raw_seq, timeout):
+                    return None
+                return self.raw
+            finally:
+                self.raw_requests -= 1
+
+    def start(self):
+        """ソフトウェアエンコード用のプロデューサスレッドを起動（起動済みなら何もしない）"""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name="frame-producer", daemon=True)
+        self.thread.start()
+
+    def _adjust_quality(self, cycle_time, streak):
+        """エンコード＋配信時間の連続超過/回復に応じて品質を上下させ、新しい streak を返す"""
+        if cycle_time > STREAM_LAG_THRESHOLD:
+            streak = min(streak, 0) - 1
+        else:
+            streak = max(streak, 0) + 1
+
+        if streak <= -STREAM_LAG_WINDOW and self.quality > STREAM_JPEG_QUALITY_MIN:
+            self.quality = max(STREAM_JPEG_QUALITY_MIN, self.quality - STREAM_JPEG_QUALITY_STEP)
+            print(f"配信遅延のためJPEG品質を下げます: {self.quality}")
+            streak = 0
+        elif streak >= STREAM_LAG_WINDOW and self.quality < STREAM_JPEG_QUALITY_MAX:
+            self.quality = min(STREAM_JPEG_QUALITY_MAX, self.quality + STREAM_JPEG_QUALITY_STEP)
+            print(f"配信が回復したためJPEG品質を上げます: {self.quality}")
+            streak = 0
+        return streak
+
+    def _run(self):
+        """カメラから取得したフレームを1回だけエンコードして publish する"""
+        pin_producer_thread()
+        error_count = 0
+        streak = 0  # 正: 連続で間に合った回数 / 負: 連続で遅れた回数
+        encode_time = 0.0
+        measured_seq = 0
+        last_thumb = None  # 最後に publish したフレームの縮小画像
+        while True:
+            try:
+                # ハードウェア経路では _JpegBuffer.write が直接 publish する
+                if hw_encoder_active():
+                    time.sleep(0.5)
+                    continue
+
+                with self.cond:
+                    if not self.viewers and not self.raw_requests:
+                        # 視聴者もスナップショット要求も無い間はカメラを読まずに待機する
+                        # 最後のフレームは破棄し、次の視聴者に古い画像を返さない
+                        self.jpeg = None
+                        self.consumed_seq = self.seq
+                        self.cond.wait_for(lambda: self.viewers or self.raw_requests)
+                    idle = self.consumed_seq != self.seq and not self.raw_requests
+                # 誰も前のフレームを受け取っていなければ、取り込みだけ進めてデコードを省く
+                if idle and grab_frame():
+                    continue
+
+                if capture_passthrough:
+                    # カメラの MJPG をそのまま publish（デコード・再エンコードなし）
+                    jpeg_bytes = get_jpeg_frame()
+                    if jpeg_bytes:
+                        # スナップショットで画素が要求された時だけ復号する
+                        raw = decode_jpeg(jpeg_bytes) if self.raw_requests else None
+                        if raw is not None:
+                            with self.cond:
+                                self.raw = raw
+                                self.raw_seq += 1
+                        self.publish(jpeg_bytes)
+                        continue
+                    frame = None
+                else:
+                    # capture_array()/read() が次フレームまでブロックするので sleep は不要
+                    frame = get_frame()
+                if frame is None:
+                    error_count += 1
+                    if error_count % 10 == 0:
+                        print(f"フレーム取得エラー: {error_count}回目")
+                    time.sleep(0.1)
                     continue
-                # バッファ空なら通常経路へフォールバック
-
-            # 既存のソフトウェア経路（cv2.imencode）
-            frame = get_frame()
-            if frame is not None:
-                ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
-                if ret:
-                    frame_count += 1
-                    if frame_count % 1000 == 0:
-                        print(f"ソフトウェア経路で送信: {frame_count}フレーム")
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
+
+                with self.cond:
+                    if self.raw_requests:
+                        # get_frame の出力バッファは次フレームで上書きされるためコピーして渡す
+                        self.raw = frame.copy()
+                        self.raw_seq += 1
+                        self.cond.notify_all()
+                    drained = self.consumed_seq == self.seq
+                    deliver_time = self.consumed_at - self.published_at
+                # 前のフレームがまだ誰にも受け取られていなければエンコードを省略
+                if not drained:
+                    continue
+                # 前回 publish したフレームから変化が無ければエンコードも送信もしない
+                # INTER_AREA の画素平均でノイズを抑え、最大差で判定するので小さな動きも拾える
+                height, width = frame.shape[:2]
+                thumb = cv2.resize(frame, (max(1, width // STREAM_STATIC_SCALE), max(1, height // STREAM_STATIC_SCALE)),
+                                   interpolation=cv2.INTER_AREA)
+                if (last_thumb is not None and last_thumb.shape == thumb.shape
+                        and time.monotonic() - self.published_at < STREAM_STATIC_MAX_INTERVAL
+                        and cv2.norm(thumb, last_thumb, cv2.NORM_INF) < STREAM_STATIC_THRESHOLD):
+                    continue
+                if self.seq != measured_seq:
+                    measured_seq = self.seq
+                    streak = self._adjust_quality(encode_time + deliver_time, streak)
+
+                start = time.monotonic()
+                jpeg_bytes = encode_jpeg(frame, self.quality)
+                encode_time = time.monotonic() - start
+                if jpeg_bytes:
+                    self.publish(jpeg_bytes)
+                    last_thumb = thumb
                 else:
                     error_count += 1
                     print("JPEGエンコードに失敗しました（ソフトウェア経路）")
-            else:
+            except Exception as e:
+                print(f"フレーム生成スレッドエラー: {e}")
                 error_count += 1
-                if error_count % 10 == 0:
-                    print(f"フレーム取得エラー: {error_count}回目")
+                time.sleep(1)
 
-            time.sleep(1.0 / max(1, CAM_FPS))
+frame_broker = FrameBroker()
 
-        except Exception as e:
-            print(f"ストリーミング生成エラー: {e}")
-            error_count += 1
-            time.sleep(1)
+# MJPEG パートヘッダの固定部分（Content-Length の値だけをフレーム毎に埋める）
+MJPEG_PART_HEADER = (b'--frame\r\n'
+                     b'Content-Type: image/jpeg\r\n'
+                     b'Content-Length: %d\r\n\r\n')
+# 2フレーム目以降は前パート末尾の CRLF を次の境界と一緒に送る
+MJPEG_NEXT_PART_HEADER = b'\r\n' + MJPEG_PART_HEADER
+
+def generate_frames():
+    """MJPEGストリーミング用のフレーム生成（FrameBroker の最新JPEGを配信）"""
+    last_seq = 0
+    part_header = MJPEG_PART_HEADER
+
+    # 送信フレーム数は FrameBroker が数え、/api/status で確認できる
+    frame_broker.add_viewer(1)
+    try:
+        while True:
+            seq, jpeg_bytes = frame_broker.wait_next(last_seq)
+            if seq == last_seq or not jpeg_bytes:
+                # タイムアウト（カメラ停止中など）
+                continue
+            last_seq = seq
+            # Content-Length を付けるとクライアントは境界文字列を走査せずにパートを読める
+            # ヘッダと JPEG 本体は別々に yield し、本体を連結コピーしない
+            yield part_header % len(jpeg_bytes)
+            yield jpeg_bytes
+            part_header = MJPEG_NEXT_PART_HEADER
+    finally:
+        frame_broker.add_viewer(-1)
+
+# ページはリクエスト毎に内容が変わらないため、レンダリング結果を使い回す
+PAGE_CACHE_HEADERS = {'Cache-Control': 'public, max-age=60'}
+_page_cache = {}
+
+def render_page(name):
+    """テンプレートを1回だけレンダリングして返す（デバッグ時は毎回レンダリング）"""
+    if app.debug:
+        return render_template(name)
+    # url_for の結果はマウント位置（SCRIPT_NAME）で変わるためキーに含める
+    key = (name, request.script_root)
+    html = _page_cache.get(key)
+    if html is None:
+        html = render_template(name)
+        _page_cache[key] = html
+    return Response(html, mimetype='text/html', headers=PAGE_CACHE_HEADERS)
 
 @app.route('/')
 def index():
     """メインページ"""
-    return render_template('index.html')
+    return render_page('index.html')
 
 @app.route('/pump_control')
 def pump_control():
     """ポンプ制御ページ"""
-    return render_template('pump_control.html')
+    return render_page('pump_control.html')
 
 @app.route('/syringe_pump')
 def syringe_pump():
     """シリンジポンプ制御ページ"""
-    return render_template('syringe_pump.html')
+    return render_page('syringe_pump.html')
 
 @app.route('/video_feed')
 def video_feed():
     """ビデオストリーミングエンドポイント"""
+    # direct_passthrough: 生成済みの bytes をそのまま WSGI サーバへ渡し、チャンク毎のラップ処理を省く
     return Response(generate_frames(),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+                    mimetype='multipart/x-mixed-replace; boundary=frame',
+                    headers={'Cache-Control': 'no-cache, no-store'},
+                    direct_passthrough=True)
+
+# H.264 fragmented MP4 配信（/video_feed.mp4）の設定
+H264_BITRATE = 2_000_000
+H264_IPERIOD = 30  # キーフレーム間隔（フレーム数）。新しい視聴者は次のキーフレームから受信する
+H264_QUEUE_SIZE = 60  # 視聴者毎に溜められるフレーム数（超えたら次のキーフレームまで間引く）
+FFMPEG_PATH = shutil.which('ffmpeg')
+# H.264 を再エンコードせずに fragmented MP4 へ詰め替える ffmpeg 引数
+FMP4_MUX_ARGS = ['-loglevel', 'error', '-f', 'h264', '-i', 'pipe:0',
+                 '-c:v', 'copy', '-f', 'mp4',
+                 '-movflags', 'frag_keyframe+empty_moov+default_base_moof', 'pipe:1']
+
+def _close_queue(q):
+    """溜まっているフレームを捨てて終了の印（None）を入れる"""
+    try:
+        while True:
+            q.get_nowait()
+    except queue.Empty:
+        pass
+    q.put_nowait(None)
+
+class H264Hub(Output):
+    """ハードウェアH.264エンコーダの出力を視聴者毎のキューへ配る（視聴者がいる間だけエンコード）"""
+
+    def __init__(self):
+        super().__init__()
+        # control_lock: エンコーダの開始/停止, lock: 視聴者一覧（エンコーダスレッドと共有）
+        self.control_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.subscribers = {}  # キュー -> キーフレーム待ちか
+        self.encoder = None
+
+    def available(self):
+        """H.264 配信が可能か（Picamera2 + H264Encoder + ffmpeg が必要）"""
+        return (H264Encoder is not None and FFMPEG_PATH is not None
+                and camera_initialized and is_raspberry_pi)
+
+    def subscribe(self):
+        """視聴者を登録し、最初の視聴者ならエンコーダを起動する"""
+        q = queue.Queue(maxsize=H264_QUEUE_SIZE)
+        with self.control_lock:
+            with self.lock:
+                self.subscribers[q] = True
+            if self.encoder is None:
+                try:
+                    # repeat=True: キーフレーム毎に SPS/PPS を付け、途中参加でも復号できるようにする
+                    encoder = H264Encoder(bitrate=H264_BITRATE, repeat=True, iperiod=H264_IPERIOD)
+                    camera.start_encoder(encoder, self, name="main")
+                except Exception:
+                    with self.lock:
+                        self.subscribers.pop(q, None)
+                    raise
+                self.encoder = encoder
+                print("H.264エンコーダを開始しました")
+        return q
+
+    def unsubscribe(self, q):
+        """視聴者を外し、誰もいなくなったらエンコーダを停止する"""
+        with self.control_lock:
+            with self.lock:
+                self.subscribers.pop(q, None)
+                idle = not self.subscribers
+            if idle:
+                self._stop_encoder()
+
+    def close_all(self):
+        """カメラ再設定前に全視聴者の配信を終了させ、エンコーダを停止する"""
+        with self.control_lock:
+            with self.lock:
+                for q in self.subscribers:
+                    _close_queue(q)
+                self.subscribers.clear()
+            self._stop_encoder()
+
+    def _stop_encoder(self):
+        # stop_encoder はエンコーダスレッドの終了を待つので self.lock の外で呼ぶ
+        if self.encoder is None:
+            return
+        encoder, self.encoder = self.encoder, None
+        try:
+            camera.stop_encoder(encoder)
+            print("H.264エンコーダを停止しました")
+        except Exception as e:
+            print(f"H.264エンコーダ停止エラー: {e}")
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        """エンコーダスレッドから呼ばれ、H.264 のフレームを各視聴者のキューへ入れる"""
+        # エンコーダの出力バッファは再利用されるためコピーしてから配る
+        data = bytes(frame)
+        with self.lock:
+            for q, waiting in self.subscribers.items():
+                if waiting:
+                    if not keyframe:
+                        continue
+                    self.subscribers[q] = False
+                try:
+                    q.put_nowait(data)
+                except queue.Full:
+                    # 送信が追いつかない視聴者は次のキーフレームから再開
+                    self.subscribers[q] = True
+
+h264_hub = H264Hub()
+
+def start_fmp4_muxer(q):
+    """登録済みの視聴者キューの H.264 を ffmpeg へ流し込むスレッドを起動し、ffmpeg のプロセスを返す"""
+    proc = subprocess.Popen([FFMPEG_PATH] + FMP4_MUX_ARGS, bufsize=0,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+
+    def feed():
+        try:
+            while True:
+                data = q.get()
+                if data is None:
+                    break
+                proc.stdin.write(data)
+        except (OSError, ValueError):
+            # ffmpeg 終了後の書き込み（視聴者切断時）は無視
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    threading.Thread(target=feed, name="fmp4-feed", daemon=True).start()
+    return proc
+
+def stop_fmp4_stream(q, proc):
+    """視聴者の登録を外して ffmpeg を終了させる（何度呼んでもよい）"""
+    h264_hub.unsubscribe(q)
+    _close_queue(q)
+    if proc is not None:
+        proc.kill()
+        proc.wait()
+
+def generate_fmp4(proc):
+    """ffmpeg が出力する fragmented MP4 をそのまま配信"""
+    try:
+        while True:
+            chunk = proc.stdout.read(65536)
+            if not chunk:
+                break
+            yield chunk
+    except Exception as e:
+        print(f"H.264配信エラー: {e}")
+
+@app.route('/video_feed.mp4')
+def video_feed_mp4():
+    """H.264 (fragmented MP4) ストリーミングエンドポイント（<video> で再生）"""
+    if not h264_hub.available():
+        return jsonify({'error': 'H.264配信は利用できません（Picamera2 と ffmpeg が必要です）'}), 503
+    # 応答を返す前に登録し、エンコーダを起動できなければ空の 200 ではなく 503 を返す
+    try:
+        q = h264_hub.subscribe()
+    except Exception as e:
+        print(f"H.264エンコーダ開始エラー: {e}")
+        return jsonify({'error': f'H.264エンコーダを開始できません: {e}'}), 503
+    # ffmpeg は登録に成功してから起動する（視聴者毎に1プロセス）
+    try:
+        proc = start_fmp4_muxer(q)
+    except Exception as e:
+        stop_fmp4_stream(q, None)
+        print(f"ffmpeg 起動エラー: {e}")
+        return jsonify({'error': f'ffmpeg を起動できません: {e}'}), 503
+    response = Response(generate_fmp4(proc),
+                        mimetype='video/mp4',
+                        headers={'Cache-Control': 'no-cache, no-store'},
+                        direct_passthrough=True)
+    # 切断時（ジェネレータが開始されなかった場合も含む）に必ず後始末する
+    response.call_on_close(lambda: stop_fmp4_stream(q, proc))
+    return response
+
+# /api/status の応答キャッシュ（生成時刻, JSONバイト列）
+STATUS_CACHE_TTL = 0.1
+_status_cache = (0.0, b'')
 
 @app.route('/api/status')
 def api_status():
     """カメラ状態API"""
+    global _status_cache
+
+    # 複数タブからのポーリングに備え、TTL 内はシリアライズ済みの応答を返す
+    now = time.monotonic()
+    cached_at, body = _status_cache
+    if now - cached_at < STATUS_CACHE_TTL:
+        return Response(body, mimetype='application/json')
+
     # カメラの詳細情報を取得
     camera_info = {
         'initialized': camera_initialized,
@@ -497,27 +1246,57 @@ def api_status():
         except Exception as e:
             camera_info['error'] = str(e)
     
-    return jsonify({
+    body = app.json.dumps({
         'camera': camera_info,
         'serial_initialized_1': serial_initialized_1,  # ハイセラポンプ1-3
         'serial_initialized_2': serial_initialized_2,  # ハイセラポンプ4-6
         'syringe_serial_initialized': syringe_serial_initialized,
         'hysera_port1_status': serial_initialized_1 and ser_1 is not None,  # COM18（ポンプ1-3）
         'hysera_port2_status': serial_initialized_2 and ser_2 is not None,  # COM20（ポンプ4-6）
+        'stream': frame_broker.stats(),
         'timestamp': time.time()
     })
+    # タプルの差し替えは原子的なのでロック不要
+    _status_cache = (now, body)
+    return Response(body, mimetype='application/json')
+
+# スナップショットに配信中のJPEGを流用してよい鮮度（秒）
+SNAPSHOT_MAX_AGE = 0.5
+SNAPSHOT_DEFAULT_QUALITY = 90
+# 画像を繰り返し取得するクライアントがキャッシュを使わず、接続は使い回すよう指定
+SNAPSHOT_HEADERS = {'Cache-Control': 'no-cache, no-store'}
 
 @app.route('/api/snapshot')
 def api_snapshot():
-    """スナップショットAPI"""
-    frame = get_frame()
+    """スナップショットAPI（?quality=N 指定時のみ再エンコード、?size=small で縮小画像）"""
+    quality = request.args.get('quality')
+    small = request.args.get('size') == 'small'
+    if quality is not None:
+        try:
+            quality = min(100, max(1, int(quality)))
+        except ValueError:
+            return jsonify({'error': f'無効な品質: {quality}'}), 400
+    elif small:
+        quality = SNAPSHOT_SMALL_QUALITY
+    else:
+        # ストリーミング中なら直近のJPEGをそのまま返し、再エンコードを省く
+        jpeg_bytes = frame_broker.latest(SNAPSHOT_MAX_AGE)
+        if jpeg_bytes:
+            return Response(jpeg_bytes, mimetype='image/jpeg', headers=SNAPSHOT_HEADERS)
+        quality = SNAPSHOT_DEFAULT_QUALITY
+
+    if small:
+        frame = get_small_frame()
+    else:
+        # 生フレームはプロデューサ経由で受け取る（動作していなければ直接取得）
+        frame = frame_broker.capture_raw() if frame_broker.producing() else get_frame()
     
     if frame is not None:
         # JPEGエンコード
-        ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        jpeg_bytes = encode_jpeg(frame, quality)
         
-        if ret:
-            return Response(buffer.tobytes(), mimetype='image/jpeg')
+        if jpeg_bytes:
+            return Response(jpeg_bytes, mimetype='image/jpeg', headers=SNAPSHOT_HEADERS)
     
     return jsonify({'error': 'スナップショット取得に失敗しました'}), 500
 
@@ -532,6 +1311,7 @@ def api_restart_camera():
         if camera is not None:
             if is_raspberry_pi and PICAMERA_AVAILABLE:
                 print("ラズパイカメラを停止中...")
+                h264_hub.close_all()
                 camera.stop()
                 camera.close()
             else:
@@ -584,31 +1364,23 @@ def api_pump_control():
             'command_bytes': []
         })
     
-    # コマンドの内容を生成（送信前に）
-    value_str = value.zfill(6)
-    cmd = bytearray(11)
-    cmd[0] = 0x02
-    
     # ポンプ番号に応じてコマンド番号を変換
-    if 1 <= pump <= 3:
-        command_pump_no = pump  # そのまま
-    elif 4 <= pump <= 6:
-        command_pump_no = pump - 3  # 4→1, 5→2, 6→3
-    else:
+    command_pump_no = pump_command_no(pump)
+    if command_pump_no is None:
         return jsonify({
             'success': False,
             'message': f'無効なポンプ番号: {pump}',
             'command_bytes': []
         })
     
-    cmd[1] = ord(str(command_pump_no))  # 変換されたコマンド番号を使用
-    cmd[2] = ord(action)
-    for i, c in enumerate(value_str):
-        cmd[3 + i] = ord(c)
-    cmd[9] = calc_checksum(cmd)
-    cmd[10] = 0x03
-    
-    success = send_serial_command(pump, action, value)
+    # コマンドは一度だけ生成し、応答の command_bytes と送信の両方に使う
+    cmd = build_pump_command(command_pump_no, action, value)
+    if cmd is None:
+        print(f"無効なコマンド: action={action}, value={value}")
+        cmd = b''
+        success = False
+    else:
+        success = write_pump_command(pump, cmd)
     
     return jsonify({
         'success': success,
@@ -616,228 +1388,91 @@ def api_pump_control():
         'command_bytes': list(cmd)  # 送信コマンドの内容を追加
     })
 
-@app.route("/api/get_current")
-def api_get_current():
-    """電流値取得API"""
+def query_pump(pump_no, cmd):
+    """生成済みの問い合わせコマンドを送信し、10バイト応答の値6桁を返す（送信失敗は False、応答不正は None）"""
+    target_ser, target_lock = pump_port(pump_no)
+
+    # 送信と応答受信の間に他のリクエストのバイトが混ざらないようポートをロック
+    with target_lock:
+        if target_ser is not None:
+            try:
+                # 前回タイムアウトした問い合わせの遅れて届いた応答などを捨ててから送信
+                target_ser.reset_input_buffer()
+            except Exception as e:
+                print(f"受信バッファのクリアに失敗しました: {e}")
+        if not write_pump_command(pump_no, cmd):
+            return False
+        # 10バイトの応答を待機（ポートは timeout=1 で開いているため最大1秒でブロック解除）
+        response = target_ser.read(10)
+
+    # 応答フォーマット: STX + ポンプNo + 値6桁 + CS + ETX
+    if (len(response) == 10 and response[0] == 0x02 and response[9] == 0x03
+            and xor_checksum(response[1:8]) == response[8]):
+        return response[2:8]
+    return None
+
+def pump_query_api(action, key, label, unit):
+    """電流値・回転数取得APIの共通処理（key: 応答JSONの値の名前）"""
     pump = request.args.get("pump", "1")
     
     try:
         pump = int(pump)
+        command_pump_no = pump_command_no(pump)
     except ValueError:
+        command_pump_no = None
+    if command_pump_no is None:
         return jsonify({
             'success': False,
-            'current': 0,
+            key: 0,
             'message': f'無効なポンプ番号: {pump}',
             'command_bytes': []
         })
     
-    # 電流データ取得コマンドを生成（送信前に）
-    value_str = "000000"
-    cmd = bytearray(11)
-    cmd[0] = 0x02
+    cmd = build_pump_command(command_pump_no, action)
     
-    # ポンプ番号に応じてコマンド番号を変換
-    if 1 <= pump <= 3:
-        command_pump_no = pump  # そのまま
-    elif 4 <= pump <= 6:
-        command_pump_no = pump - 3  # 4→1, 5→2, 6→3
-    else:
+    value = query_pump(pump, cmd)
+    if value is False:
         return jsonify({
             'success': False,
-            'current': 0,
-            'message': f'無効なポンプ番号: {pump}',
-            'command_bytes': list(cmd)
-        })
-    
-    cmd[1] = ord(str(command_pump_no))  # 変換されたコマンド番号を使用
-    cmd[2] = ord("C")  # 電流値取得コマンド
-    for i, c in enumerate(value_str):
-        cmd[3 + i] = ord(c)
-    cmd[9] = calc_checksum(cmd)
-    cmd[10] = 0x03
-    
-    # 電流データ取得コマンドを送信
-    success = send_serial_command(pump, "C", "000000")
-    
-    if not success:
-        return jsonify({
-            'success': False,
-            'current': 0,
+            key: 0,
             'message': '送信失敗',
             'command_bytes': list(cmd)  # 送信コマンドの内容を追加
         })
-    
-    # 応答を待機（最大1秒）
-    import time
-    start_time = time.time()
-    response = None
-    
-    # ポンプ番号に応じて適切なシリアルポートを選択
-    if 1 <= pump <= 3:
-        target_ser = ser_1
-        port_name = f"COM1-3({SERIAL_PORT_1})"
-    elif 4 <= pump <= 6:
-        target_ser = ser_2
-        port_name = f"COM4-6({SERIAL_PORT_2})"
-    else:
+    if value is None:
         return jsonify({
             'success': False,
-            'current': 0,
-            'message': f'無効なポンプ番号: {pump}',
+            key: 0,
+            'message': '応答タイムアウトまたはエラー',
             'command_bytes': list(cmd)
         })
     
-    while time.time() - start_time < 1.0:
-        if target_ser.in_waiting >= 10:  # 10バイトの応答を待機
-            response = target_ser.read(10)
-            break
-        time.sleep(0.01)
-    
-    if response and len(response) == 10:
-        # 応答フォーマット: STX + ポンプNo + 電流値(符号+5桁整数) + CS + ETX
-        if response[0] == 0x02 and response[9] == 0x03:
-            # チェックサム検証
-            checksum = 0
-            for i in range(1, 8):
-                checksum ^= response[i]
-            
-            if checksum == response[8]:
-                # 電流値を解析
-                current_str = response[2:8].decode('ascii')
-                try:
-                    current = int(current_str)
-                    return jsonify({
-                        'success': True,
-                        'current': current,
-                        'message': f'電流値取得完了: {current}mA',
-                        'command_bytes': list(cmd)  # 送信コマンドの内容を追加
-                    })
-                except ValueError:
-                    return jsonify({
-                        'success': False,
-                        'current': 0,
-                        'message': '電流値解析エラー',
-                        'command_bytes': list(cmd)  # 送信コマンドの内容を追加
-                    })
-    
-    return jsonify({
-        'success': False,
-        'current': 0,
-        'message': '応答タイムアウトまたはエラー',
-        'command_bytes': list(cmd)  # 送信コマンドの内容を追加
-    })
-
-@app.route("/api/get_rpm")
-def api_get_rpm():
-    """回転数取得API"""
-    pump = request.args.get("pump", "1")
-    
     try:
-        pump = int(pump)
+        # 値は ASCII の符号付き整数（int は bytes をそのまま受け付ける）
+        number = int(value)
     except ValueError:
         return jsonify({
             'success': False,
-            'rpm': 0,
-            'message': f'無効なポンプ番号: {pump}',
-            'command_bytes': []
-        })
-    
-    # 回転数データ取得コマンドを生成（送信前に）
-    value_str = "000000"
-    cmd = bytearray(11)
-    cmd[0] = 0x02
-    
-    # ポンプ番号に応じてコマンド番号を変換
-    if 1 <= pump <= 3:
-        command_pump_no = pump  # そのまま
-    elif 4 <= pump <= 6:
-        command_pump_no = pump - 3  # 4→1, 5→2, 6→3
-    else:
-        return jsonify({
-            'success': False,
-            'rpm': 0,
-            'message': f'無効なポンプ番号: {pump}',
-            'command_bytes': list(cmd)
-        })
-    
-    cmd[1] = ord(str(command_pump_no))  # 変換されたコマンド番号を使用
-    cmd[2] = ord("X")  # 回転数取得コマンド
-    for i, c in enumerate(value_str):
-        cmd[3 + i] = ord(c)
-    cmd[9] = calc_checksum(cmd)
-    cmd[10] = 0x03
-    
-    # 回転数データ取得コマンドを送信
-    success = send_serial_command(pump, "X", "000000")
-    
-    if not success:
-        return jsonify({
-            'success': False,
-            'rpm': 0,
-            'message': '送信失敗',
-            'command_bytes': list(cmd)  # 送信コマンドの内容を追加
-        })
-    
-    # 応答を待機（最大1秒）
-    import time
-    start_time = time.time()
-    response = None
-    
-    # ポンプ番号に応じて適切なシリアルポートを選択
-    if 1 <= pump <= 3:
-        target_ser = ser_1
-        port_name = f"COM1-3({SERIAL_PORT_1})"
-    elif 4 <= pump <= 6:
-        target_ser = ser_2
-        port_name = f"COM4-6({SERIAL_PORT_2})"
-    else:
-        return jsonify({
-            'success': False,
-            'rpm': 0,
-            'message': f'無効なポンプ番号: {pump}',
+            key: 0,
+            'message': f'{label}解析エラー',
             'command_bytes': list(cmd)
         })
-    
-    while time.time() - start_time < 1.0:
-        if target_ser.in_waiting >= 10:  # 10バイトの応答を待機
-            response = target_ser.read(10)
-            break
-        time.sleep(0.01)
-    
-    if response and len(response) == 10:
-        # 応答フォーマット: STX + ポンプNo + RPM(6桁整数) + CS + ETX
-        if response[0] == 0x02 and response[9] == 0x03:
-            # チェックサム検証
-            checksum = 0
-            for i in range(1, 8):
-                checksum ^= response[i]
-            
-            if checksum == response[8]:
-                # 回転数を解析
-                rpm_str = response[2:8].decode('ascii')
-                try:
-                    rpm = int(rpm_str)
-                    return jsonify({
-                        'success': True,
-                        'rpm': rpm,
-                        'message': f'回転数取得完了: {rpm}rpm',
-                        'command_bytes': list(cmd)  # 送信コマンドの内容を追加
-                    })
-                except ValueError:
-                    return jsonify({
-                        'success': False,
-                        'rpm': 0,
-                        'message': '回転数解析エラー',
-                        'command_bytes': list(cmd)  # 送信コマンドの内容を追加
-                    })
-    
     return jsonify({
-        'success': False,
-        'rpm': 0,
-        'message': '応答タイムアウトまたはエラー',
-        'command_bytes': list(cmd)  # 送信コマンドの内容を追加
+        'success': True,
+        key: number,
+        'message': f'{label}取得完了: {number}{unit}',
+        'command_bytes': list(cmd)
     })
 
+@app.route("/api/get_current")
+def api_get_current():
+    """電流値取得API"""
+    return pump_query_api("C", 'current', '電流値', 'mA')
+
+@app.route("/api/get_rpm")
+def api_get_rpm():
+    """回転数取得API"""
+    return pump_query_api("X", 'rpm', '回転数', 'rpm')
+
 @app.route("/api/syringe_pump_control")
 def api_syringe_pump_control():
     """シリンジポンプ制御API"""
@@ -847,18 +1482,17 @@ def api_syringe_pump_control():
     
     try:
         pump_index = int(pump_index) - 1  # 0ベースのインデックスに変換
-        if pump_index < 0:
+        if 0 <= pump_index < len(syringe_pump_controllers):
+            controller = syringe_pump_controllers[pump_index]
+        else:
+            # シリアル未初期化でも、コマンド内容は返すため予備のコントローラを使う
+            controller = _fallback_syringe_controllers.get(pump_index + 1)
+        if controller is None:
             return jsonify({
                 'success': False,
                 'message': f'無効なポンプ番号: {pump_index + 1}'
             })
         
-        # シリアル未初期化でも、コマンド内容は返すため一時コントローラを生成
-        if 0 <= pump_index < len(syringe_pump_controllers):
-            controller = syringe_pump_controllers[pump_index]
-        else:
-            controller = SyringePumpController(pump_index + 1, ser_syringe)
-        
         # フロントエンドから選択されたアドレスを取得
         selected_address = request.args.get("address", "1")
         try:
@@ -880,11 +1514,16 @@ def api_syringe_pump_control():
             message = "停止コマンド送信完了" if success else "停止コマンド送信失敗"
         elif action == "loop":
             # ループコマンド: "P" + 下移動ステップ数 + "D" + 上移動ステップ数 + "G" + ループ数
-            down_steps = request.args.get("downSteps", "3000")
-            up_steps = request.args.get("steps", "3000")
-            loop_count = request.args.get("loopCount", "0")
-            loop_command = f"P{down_steps}D{up_steps}G{loop_count}R"
-            success, command_bytes = controller.send_command(loop_command, selected_address)
+            try:
+                down_steps = int(request.args.get("downSteps", "3000"))
+                up_steps = int(request.args.get("steps", "3000"))
+                loop_count = int(request.args.get("loopCount", "0"))
+            except ValueError:
+                return jsonify({
+                    'success': False,
+                    'message': '無効なループパラメータです（整数で指定してください）'
+                })
+            success, command_bytes = controller.loop(down_steps, up_steps, loop_count, selected_address)
             message = f"ループコマンド送信完了（下:{down_steps}、上:{up_steps}、ループ:{loop_count}）" if success else "ループコマンド送信失敗"
         elif action == "qr":
             success, command_bytes = controller.send_command("QR", selected_address)
@@ -919,21 +1558,28 @@ def apply_camera_settings():
             return False
         if is_raspberry_pi and PICAMERA_AVAILABLE:
             print(f"Picamera2 に設定を適用: {CAM_WIDTH}x{CAM_HEIGHT}@{CAM_FPS}fps")
+            recording = hw_encoder_active()
+            # H.264 視聴者は解像度が変わるため一旦切断（クライアントは再接続する）
+            h264_hub.close_all()
             try:
-                # 再設定は一度停止して configure -> start
-                camera.stop()
+                # 再設定は一度停止して configure -> start（エンコーダ動作中は録画ごと停止）
+                if recording:
+                    camera.stop_recording()
+                else:
+                    camera.stop()
             except Exception:
                 pass
-            config = camera.create_preview_configuration(
-                main={"size": (CAM_WIDTH, CAM_HEIGHT), "format": "RGB888"},
-                buffer_count=4
-            )
+            config = create_camera_config()
             camera.configure(config)
             try:
                 camera.set_controls({"FrameRate": CAM_FPS})
             except Exception as e:
                 print(f"FrameRate設定エラー: {e}")
-            camera.start()
+            if recording:
+                # start_recording はカメラの start も行う
+                camera.start_recording(jpeg_encoder, jpeg_output)
+            else:
+                camera.start()
         else:
             print(f"OpenCV カメラに設定を適用: {CAM_WIDTH}x{CAM_HEIGHT}@{CAM_FPS}fps")
             try:
@@ -947,6 +1593,22 @@ def apply_camera_settings():
         print(f"apply_camera_settings エラー: {e}")
         return False
 
+def apply_frame_rate():
+    """解像度はそのままで CAM_FPS だけをカメラに反映（停止・再設定しない）"""
+    try:
+        if camera is None:
+            print("apply_frame_rate: カメラ未初期化")
+            return False
+        if is_raspberry_pi and PICAMERA_AVAILABLE:
+            camera.set_controls({"FrameRate": CAM_FPS})
+        else:
+            camera.set(cv2.CAP_PROP_FPS, CAM_FPS)
+        print(f"FrameRate を {CAM_FPS}fps に変更しました")
+        return True
+    except Exception as e:
+        print(f"apply_frame_rate エラー: {e}")
+        return False
+
 @app.route('/api/get_camera_settings')
 def api_get_camera_settings():
     return jsonify({
@@ -964,16 +1626,22 @@ def api_set_camera_settings():
     h = request.args.get('height')
     f = request.args.get('fps')
     try:
-        if w is not None:
-            CAM_WIDTH = int(w)
-        if h is not None:
-            CAM_HEIGHT = int(h)
-        if f is not None:
-            CAM_FPS = int(f)
+        new_width = int(w) if w is not None else CAM_WIDTH
+        new_height = int(h) if h is not None else CAM_HEIGHT
+        new_fps = int(f) if f is not None else CAM_FPS
     except ValueError:
         return jsonify({'success': False, 'message': '無効なパラメータ'}), 400
 
-    success = apply_camera_settings()
+    # 解像度が変わるときだけ停止・再設定する（数百ms止まりフレームが落ちるため）
+    if (new_width, new_height) != (CAM_WIDTH, CAM_HEIGHT):
+        CAM_WIDTH, CAM_HEIGHT, CAM_FPS = new_width, new_height, new_fps
+        success = apply_camera_settings()
+    elif new_fps != CAM_FPS:
+        CAM_FPS = new_fps
+        success = apply_frame_rate()
+    else:
+        # 変更なし：カメラには触れない
+        success = True
     return jsonify({
         'success': success,
         'width': CAM_WIDTH,
@@ -983,10 +1651,7 @@ def api_set_camera_settings():
 
 # --- 変更: BufferedIOBase を継承する JPEG バッファ ---
 class _JpegBuffer(io.BufferedIOBase):
-    def __init__(self):
-        super().__init__()
-        self.lock = threading.Lock()
-        self._data = b''
+    """エンコーダ出力の JPEG を再エンコードせずに FrameBroker へそのまま渡す"""
 
     def writable(self):
         return True
@@ -995,8 +1660,8 @@ class _JpegBuffer(io.BufferedIOBase):
         """FileOutput から渡される JPEG バイト列を受け取る"""
         if not isinstance(b, (bytes, bytearray)):
             b = bytes(b)
-        with self.lock:
-            self._data = b
+        # 最新フレームの保持と通知は FrameBroker の Condition が担う
+        frame_broker.publish(b)
         # 書き込んだバイト数を返す（BufferedIOBase の規約）
         return len(b)
 
@@ -1004,68 +1669,50 @@ class _JpegBuffer(io.BufferedIOBase):
         # 何もしない（必要なら実装）
         return None
 
-    def get(self):
-        with self.lock:
-            return self._data
+# --capture-size のプリセット（低遅延 / 標準 / 高画質）
+CAPTURE_SIZE_PRESETS = {
+    'low': (320, 240),
+    'vga': (640, 480),
+    'hd': (1280, 720),
+}
+
+def parse_capture_size(text):
+    """'320x240' 形式またはプリセット名を (幅, 高さ) に変換（argparse の type 用）"""
+    preset = CAPTURE_SIZE_PRESETS.get(text.lower())
+    if preset:
+        return preset
+    try:
+        w, h = (int(v) for v in text.lower().split('x'))
+    except ValueError:
+        raise ValueError(f"無効な解像度: {text}")
+    if w <= 0 or h <= 0:
+        raise ValueError(f"無効な解像度: {text}")
+    return w, h
 
 # グローバル変数
 jpeg_buffer = None
 jpeg_encoder = None
 jpeg_output = None
 
-if __name__ == '__main__':
-    import argparse
-    
-    # コマンドライン引数の解析
-    parser = argparse.ArgumentParser(description='ラズパイカメラストリーミング + ポンプ制御Webサーバー')
-    parser.add_argument('--debug', action='store_true', help='デバッグモードで起動')
-    parser.add_argument('--port', type=int, default=5000, help='ポート番号（デフォルト: 5000）')
-    parser.add_argument('--host', type=str, default='0.0.0.0', help='ホストアドレス（デフォルト: 0.0.0.0）')
-    # OSに応じたデフォルトポート設定
-    default_port_1 = 'COM18' if IS_WINDOWS else '/dev/ttyACM0'
-    default_port_2 = 'COM20' if IS_WINDOWS else '/dev/ttyACM1'
-    default_syringe_port = 'COM19' if IS_WINDOWS else '/dev/ttyACM2'
-    
-    parser.add_argument('--serial-port-1', type=str, default=default_port_1, 
-                       help=f'ハイセラポンプ1-3用シリアルポート（デフォルト: {default_port_1}）')
-    parser.add_argument('--serial-port-2', type=str, default=default_port_2, 
-                       help=f'ハイセラポンプ4-6用シリアルポート（デフォルト: {default_port_2}）')
-    parser.add_argument('--syringe-serial-port', type=str, default=default_syringe_port, 
-                       help=f'シリンジポンプ用シリアルポート（デフォルト: {default_syringe_port}）')
-    
-    args = parser.parse_args()
-    
-    # シリアルポート設定を更新（ハイセラ／シリンジ）
-    # コマンドライン引数で指定された場合は上書き
-    SERIAL_PORT_1 = args.serial_port_1
-    SERIAL_PORT_2 = args.serial_port_2
-    SYRINGE_SERIAL_PORT = args.syringe_serial_port
-    
-    # システム情報表示
-    print("=" * 50)
-    print("システム情報:")
-    print(f"OS: {platform.system()} {platform.release()}")
-    print(f"Python: {platform.python_version()}")
-    print(f"カメラライブラリ: {'Picamera2' if PICAMERA_AVAILABLE else 'OpenCV'}")
-    print("=" * 50)
-    
-    # シリアルポート設定表示
-    print("\nシリアルポート設定:")
-    print(f"ハイセラポンプ1-3用: {SERIAL_PORT_1}")
-    print(f"ハイセラポンプ4-6用: {SERIAL_PORT_2}")
-    print(f"シリンジポンプ用: {SYRINGE_SERIAL_PORT}")
-    print("=" * 50)
-    
-    # カメラ初期化前のシステムチェック
-    print("\nカメラ初期化前のシステムチェック...")
+def system_diagnostics():
+    """カメラモジュール状態・ビデオデバイス・OpenCVバージョンを確認して返す"""
+    info = {
+        'os': f"{platform.system()} {platform.release()}",
+        'python': platform.python_version(),
+        'camera_library': 'Picamera2' if PICAMERA_AVAILABLE else 'OpenCV',
+        'opencv_version': cv2.__version__,
+        'camera_module': None,
+        'video_devices': [],
+    }
+    print("\nシステムチェック...")
     if not IS_WINDOWS:
         try:
             # カメラモジュールの状態確認
-            import subprocess
             result = subprocess.run(['vcgencmd', 'get_camera'], 
                                  capture_output=True, text=True, timeout=5)
             if result.returncode == 0:
-                print(f"✓ カメラモジュール状態: {result.stdout.strip()}")
+                info['camera_module'] = result.stdout.strip()
+                print(f"✓ カメラモジュール状態: {info['camera_module']}")
             else:
                 print("✗ カメラモジュール状態確認に失敗")
         except Exception as e:
@@ -1073,8 +1720,8 @@ if __name__ == '__main__':
         
         try:
             # カメラデバイスの確認
-            import os
             video_devices = [f for f in os.listdir('/dev') if f.startswith('video')]
+            info['video_devices'] = video_devices
             if video_devices:
                 print(f"✓ 利用可能なビデオデバイス: {video_devices}")
                 # ラズパイカメラモジュール用のデバイスを特定
@@ -1087,17 +1734,54 @@ if __name__ == '__main__':
                 print("✗ ビデオデバイスが見つかりません")
         except Exception as e:
             print(f"✗ ビデオデバイス確認エラー: {e}")
-        
-        # OpenCVのバージョン確認
-        try:
-            opencv_version = cv2.__version__
-            print(f"✓ OpenCVバージョン: {opencv_version}")
-        except Exception as e:
-            print(f"✗ OpenCVバージョン確認エラー: {e}")
+    print(f"✓ OpenCVバージョン: {info['opencv_version']}")
+    return info
+
+@app.route('/api/system_info')
+def api_system_info():
+    """システム診断API（vcgencmd 等は起動時ではなくここで必要な時だけ実行）"""
+    return jsonify(system_diagnostics())
+
+def initialize_hardware(serial_port_1=None, serial_port_2=None, syringe_serial_port=None,
+                        capture_size=None, diagnostics=False):
+    """カメラとシリアル通信を初期化（開発サーバー / gunicorn 共通）"""
+    global SERIAL_PORT_1, SERIAL_PORT_2, SYRINGE_SERIAL_PORT, CAM_WIDTH, CAM_HEIGHT
+    if capture_size:
+        # 表示に必要な解像度で取得すれば、取得・エンコード・送信の全段でデータ量が減る
+        CAM_WIDTH, CAM_HEIGHT = capture_size
+    # ポート設定はここで1回だけ確定させ、以降は各初期化関数に明示的に渡す
+    SERIAL_PORT_1 = serial_port_1 or SERIAL_PORT_1
+    SERIAL_PORT_2 = serial_port_2 or SERIAL_PORT_2
+    SYRINGE_SERIAL_PORT = syringe_serial_port or SYRINGE_SERIAL_PORT
     
-    # カメラ初期化
-    print("\nカメラ初期化を開始します...")
-    camera_success = initialize_camera()
+    # システム情報表示
+    print("=" * 50)
+    print("システム情報:")
+    print(f"OS: {platform.system()} {platform.release()}")
+    print(f"Python: {platform.python_version()}")
+    print(f"カメラライブラリ: {'Picamera2' if PICAMERA_AVAILABLE else 'OpenCV'}")
+    print("=" * 50)
+    
+    # シリアルポート設定表示
+    print("\nシリアルポート設定:")
+    print(f"ハイセラポンプ1-3用: {SERIAL_PORT_1}")
+    print(f"ハイセラポンプ4-6用: {SERIAL_PORT_2}")
+    print(f"シリンジポンプ用: {SYRINGE_SERIAL_PORT}")
+    print("=" * 50)
+    
+    if diagnostics:
+        # 起動を遅らせないよう、通常は /api/system_info で必要な時だけ確認する
+        system_diagnostics()
+    
+    # カメラとシリアル（ハイセラ／シリンジ）は互いに独立なので並行して初期化
+    print("\nカメラ・シリアル通信の初期化を開始します...")
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        camera_future = executor.submit(initialize_camera)
+        serial_future = executor.submit(initialize_serial, SERIAL_PORT_1, SERIAL_PORT_2)
+        syringe_future = executor.submit(initialize_syringe_serial, SYRINGE_SERIAL_PORT)
+    camera_success = camera_future.result()
+    serial_success = serial_future.result()
+    syringe_serial_success = syringe_future.result()
     
     if camera_success:
         print(f"✓ カメラ初期化成功: {'Raspberry Pi' if is_raspberry_pi else 'PC'}カメラ")
@@ -1110,17 +1794,6 @@ if __name__ == '__main__':
         else:
             print("   → PCにWebカメラが接続されているか確認してください")
     
-    # シリアル通信初期化（ハイセラ／シリンジ）
-    print("\nシリアル通信初期化を開始します...")
-    serial_success = initialize_serial()
-    syringe_serial_success = initialize_syringe_serial()
-    
-    print("\n" + "=" * 50)
-    print("Webサーバーを起動します...")
-    print(f"ブラウザで http://localhost:{args.port} にアクセスしてください")
-    print(f"ポンプ制御ページ: http://localhost:{args.port}/pump_control")
-    print("=" * 50)
-    
     if not serial_success:
         print("警告: ハイセラポンプ用シリアル通信の初期化に失敗しました。")
         print(f"シリアルポート {SERIAL_PORT_1}（ポンプ1-3用）または {SERIAL_PORT_2}（ポンプ4-6用）が利用可能か確認してください。")
@@ -1133,6 +1806,55 @@ if __name__ == '__main__':
         if not IS_WINDOWS:
             print("   → ラズパイでUSBデバイスが認識されているか確認してください")
             print("   → デバイス権限があるか確認してください")
+
+if __name__ == '__main__':
+    import argparse
     
-    # 開発サーバー起動（本番環境ではgunicorn等を使用）
-    app.run(host=args.host, port=args.port, debug=args.debug, threaded=True)
\ No newline at end of file
+    # コマンドライン引数の解析
+    parser = argparse.ArgumentParser(description='ラズパイカメラストリーミング + ポンプ制御Webサーバー')
+    parser.add_argument('--debug', action='store_true', help='デバッグモードで起動')
+    parser.add_argument('--port', type=int, default=5000, help='ポート番号（デフォルト: 5000）')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='ホストアドレス（デフォルト: 0.0.0.0）')
+    # OSに応じたデフォルトポート設定
+    default_port_1 = 'COM18' if IS_WINDOWS else '/dev/ttyACM0'
+    default_port_2 = 'COM20' if IS_WINDOWS else '/dev/ttyACM1'
+    default_syringe_port = 'COM19' if IS_WINDOWS else '/dev/ttyACM2'
+    
+    parser.add_argument('--serial-port-1', type=str, default=default_port_1, 
+                       help=f'ハイセラポンプ1-3用シリアルポート（デフォルト: {default_port_1}）')
+    parser.add_argument('--serial-port-2', type=str, default=default_port_2, 
+                       help=f'ハイセラポンプ4-6用シリアルポート（デフォルト: {default_port_2}）')
+    parser.add_argument('--syringe-serial-port', type=str, default=default_syringe_port, 
+                       help=f'シリンジポンプ用シリアルポート（デフォルト: {default_syringe_port}）')
+    
+    parser.add_argument('--capture-size', type=parse_capture_size, default=None,
+                        help=f'取得解像度 WxH またはプリセット {"/".join(CAPTURE_SIZE_PRESETS)}'
+                             f'（デフォルト: {CAM_WIDTH}x{CAM_HEIGHT}）')
+    
+    args = parser.parse_args()
+    
+    # コマンドライン引数のシリアルポート（ハイセラ／シリンジ）を渡して初期化
+    initialize_hardware(args.serial_port_1, args.serial_port_2, args.syringe_serial_port,
+                        capture_size=args.capture_size, diagnostics=args.debug)
+    
+    print("\n" + "=" * 50)
+    print("Webサーバーを起動します...")
+    print(f"ブラウザで http://localhost:{args.port} にアクセスしてください")
+    print(f"ポンプ制御ページ: http://localhost:{args.port}/pump_control")
+    print("=" * 50)
+    
+    if args.debug:
+        # デバッグ時は開発サーバー（自動リロード・デバッガ付き）
+        app.run(host=args.host, port=args.port, debug=True, threaded=True)
+    else:
+        try:
+            # スレッドプール型の WSGI サーバー（Windows でも動作）
+            from waitress import serve
+        except ImportError:
+            print("⚠ 警告: waitress が見つかりません。Werkzeug の開発サーバーで起動します")
+            print("   → 開発サーバーは本番運用向けではありません。waitress をインストールしてください")
+            print("   → オフライン環境では waitress の .whl を USB メモリに配置して setup.py を再実行してください")
+            app.run(host=args.host, port=args.port, threaded=True)
+        else:
+            print("waitress で起動します")
+            serve(app, host=args.host, port=args.port, threads=16, connection_limit=64)
\ No newline at end of file
@@ -1,31 +1,47 @@
+import functools
 import serial
+import threading
 import time
 
+def xor_checksum(data: bytes) -> int:
+    """全バイトのXORを整数演算で計算（半分ずつ畳み込むのでバイト毎のループが不要）"""
+    value = int.from_bytes(data, 'little')
+    width = 8 * len(data)
+    while width > 8:
+        # 上位側を下位側に重ねて XOR し、幅を半分（バイト単位で切り上げ）にする
+        width = (width + 15) // 16 * 8
+        value = (value ^ (value >> width)) & ((1 << width) - 1)
+    return value & 0xFF
+
+@functools.lru_cache(maxsize=256)
+def build_frame(command: str, address: int) -> bytes:
+    """コマンドフレームを作成（同じコマンドとアドレスの組は結果を使い回す）"""
+    # Frame: STX(0x02) + [ADDR ASCII] + [0x31] + [COMMAND ASCII] + ETX(0x03) + [CS(1byte XOR)]
+    # アドレスは1文字のASCII、その後に0x31、そしてコマンド文字列
+    body_bytes = bytes([ord(str(address))]) + bytes([0x31]) + command.encode('ascii')
+    frame_without_cs = bytes([0x02]) + body_bytes + bytes([0x03])
+    # STXからETXまで含めた全バイトのXORチェックサム
+    return frame_without_cs + bytes([xor_checksum(frame_without_cs)])
+
 class SyringePumpController:
-    def __init__(self, pump_number: int, serial_port: serial.Serial):
+    def __init__(self, pump_number: int, serial_port: serial.Serial, lock: threading.Lock = None):
         self.pump_number = pump_number
         self.serial_port = serial_port
+        # 同じポートを共有する全コントローラで同一のロックを渡す
+        self.lock = lock if lock is not None else threading.Lock()
         self.address = 1  # プレースホルダー、pump_numberから派生するか渡す必要があります
         self.status = "Stop"
         
     def create_command(self, command: str, address: int) -> bytes:
         """コマンドフレームを作成（チェックサム付き）"""
-        # Frame: STX(0x02) + [ADDR ASCII] + [0x31] + [COMMAND ASCII] + ETX(0x03) + [CS(1byte XOR)]
-        # アドレスは1文字のASCII、その後に0x31、そしてコマンド文字列
-        body_bytes = bytes([ord(str(address))]) + bytes([0x31]) + command.encode('ascii')
-        frame_without_cs = bytes([0x02]) + body_bytes + bytes([0x03])
-        # STXからETXまで含めた全バイトのXORチェックサム
-        checksum = 0
-        for byte in frame_without_cs:
-            checksum ^= byte
-        frame = frame_without_cs + bytes([checksum])
-        return frame
+        return build_frame(command, address)
     
     def send_command(self, command: str, address: int) -> tuple[bool, bytes]:
         """コマンドを送信"""
         try:
             full_command = self.create_command(command, address)
-            self.serial_port.write(full_command)
+            with self.lock:
+                self.serial_port.write(full_command)
             print(f"[Pump {self.pump_number}] 送信: {full_command.hex()}")
             return True, full_command
         except Exception as e:
@@ -33,3 +49,8 @@ class SyringePumpController:
             # Always return the command bytes even if serial communication fails
             full_command = self.create_command(command, address)
             return False, full_command
+
+    def loop(self, down_steps: int, up_steps: int, loop_count: int, address: int) -> tuple[bool, bytes]:
+        """ループコマンドを送信（下移動 → 上移動 を loop_count 回繰り返す）"""
+        # 数値は呼び出し側で int に変換済み。1回の書式化でコマンド文字列を作る
+        return self.send_command("P%dD%dG%dR" % (down_steps, up_steps, loop_count), address)
@@ -8,10 +8,48 @@ import os
 import sys
 import subprocess
 import platform
-import urllib.request
+import http.client
+import shutil
+import threading
 import json
+import re
+import time
+from urllib.parse import urljoin, urlsplit
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+# packaging があれば wheel のタグ判定・バージョン比較に使う（なければ簡易判定）
+try:
+    from packaging.requirements import InvalidRequirement, Requirement
+    from packaging.tags import sys_tags
+    from packaging.utils import InvalidWheelFilename, canonicalize_name, parse_wheel_filename
+    from packaging.version import InvalidVersion, Version
+    PACKAGING_AVAILABLE = True
+except ImportError:
+    PACKAGING_AVAILABLE = False
+
+# PyPI への同時リクエスト数（待ち時間は通信遅延なので並行化で短縮、数は控えめに）
+# ワーカースレッドは情報取得とダウンロードで共有し、スレッド毎の接続を使い回す
+MAX_WORKERS = 10
+# wheel の同時ダウンロード数
+DOWNLOAD_WORKERS = 5
+_download_slots = threading.BoundedSemaphore(DOWNLOAD_WORKERS)
+
+# PyPI のパッケージ情報のキャッシュ（リリース一覧は頻繁に変わらないので24時間使い回す）
+CACHE_DIR = Path.home() / ".cache" / "raspi-camera" / "pypi"
+CACHE_TTL = 24 * 60 * 60
+
+HTTP_TIMEOUT = 30
+MAX_REDIRECTS = 5
+# 429 / 503 応答の再試行回数と1回あたりの最大待ち時間（秒）
+MAX_RETRIES = 3
+MAX_RETRY_DELAY = 60
+# ダウンロード時に1回で読み書きするサイズ
+CHUNK_SIZE = 64 * 1024
+
+# ホストごとの HTTPS 接続（スレッドごと）。keep-alive で TCP/TLS 接続を使い回す
+_connections = threading.local()
+
 def get_python_version():
     """Pythonバージョンを取得"""
     version = sys.version_info
@@ -27,11 +65,81 @@ def get_architecture():
     else:
         return arch
 
+# 実行中は変わらないシステム情報（wheel 判定のたびに計算しないよう起動時に1回だけ求める）
+PYTHON_VERSION = get_python_version()
+PYTHON_TAG = f"cp{PYTHON_VERSION.replace('.', '')}"
+ARCHITECTURE = get_architecture()
+# この環境でインストールできる wheel タグ（sys_tags は数百個のタグを生成する）
+COMPATIBLE_TAGS = frozenset(sys_tags()) if PACKAGING_AVAILABLE else None
+
+def get_connection(host):
+    """このスレッドで使っている host への接続を返す（なければ作成）"""
+    pool = getattr(_connections, 'pool', None)
+    if pool is None:
+        pool = _connections.pool = {}
+    conn = pool.get(host)
+    if conn is None:
+        conn = pool[host] = http.client.HTTPSConnection(host, timeout=HTTP_TIMEOUT)
+    return conn
+
+def retry_delay(retry_after, retries):
+    """再試行までの待ち時間（秒）を返す"""
+    try:
+        return min(float(retry_after), MAX_RETRY_DELAY)
+    except (TypeError, ValueError):
+        return min(2 ** retries, MAX_RETRY_DELAY)
+
+def http_get(url, out=None):
+    """GET して本文を返す（out を渡すと本文をそこへ逐次書き込む）"""
+    redirects = 0
+    retries = 0
+    while True:
+        parts = urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        conn = get_connection(parts.netloc)
+        try:
+            try:
+                conn.request("GET", path)
+                response = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                # keep-alive 中にサーバー側で切断された接続は張り直して1回だけ再試行
+                conn.close()
+                conn.request("GET", path)
+                response = conn.getresponse()
+            
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                redirects += 1
+                if redirects > MAX_REDIRECTS:
+                    raise OSError(f"リダイレクトが多すぎます: {url}")
+                url = urljoin(url, response.getheader("Location"))
+                continue
+            if response.status in (429, 503) and retries < MAX_RETRIES:
+                # 混雑時は Retry-After（なければ指数的に延ばした時間）だけ待って再試行
+                response.read()
+                retries += 1
+                time.sleep(retry_delay(response.getheader("Retry-After"), retries))
+                continue
+            if response.status != 200:
+                response.read()
+                raise OSError(f"HTTP {response.status} {response.reason}")
+            if out is None:
+                return response.read()
+            shutil.copyfileobj(response, out, CHUNK_SIZE)
+            return None
+        except Exception:
+            # 読み残しのある接続は再利用できないので閉じる（次回の request で再接続される）
+            conn.close()
+            raise
+
 def download_file(url, filename):
     """ファイルをダウンロード"""
     try:
-        print(f"📥 ダウンロード中: {filename}")
-        urllib.request.urlretrieve(url, filename)
+        # 共有ワーカーのうち同時にダウンロードするのは DOWNLOAD_WORKERS 個まで
+        with _download_slots:
+            print(f"📥 ダウンロード中: {filename}")
+            with open(filename, "wb") as f:
+                http_get(url, f)
         print(f"✅ ダウンロード完了: {filename}")
         return True
     except Exception as e:
@@ -39,17 +147,99 @@ def download_file(url, filename):
         return False
 
 def get_package_info(package_name):
-    """PyPIからパッケージ情報を取得"""
+    """PyPIからパッケージ情報を取得（キャッシュが新しければ通信しない）"""
+    cache_path = CACHE_DIR / f"{package_name.lower()}.json"
+    try:
+        if time.time() - cache_path.stat().st_mtime < CACHE_TTL:
+            return json.loads(cache_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        pass
+    
     try:
         url = f"https://pypi.org/pypi/{package_name}/json"
-        with urllib.request.urlopen(url) as response:
-            data = json.loads(response.read())
-            return data
+        body = http_get(url)
+        data = json.loads(body)
     except Exception as e:
         print(f"❌ パッケージ情報取得失敗: {package_name} - {e}")
         return None
+    
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        cache_path.write_bytes(body)
+    except OSError as e:
+        print(f"⚠️  キャッシュ保存失敗: {package_name} - {e}")
+    return data
+
+def fetch_package_infos(executor, package_names):
+    """複数パッケージの情報を並行して取得（{パッケージ名: 情報} を返す）"""
+    return dict(zip(package_names, executor.map(get_package_info, package_names)))
+
+def get_requirements(package_info):
+    """requires_dist から、この環境で必要な依存パッケージ名を返す（extras 専用の依存は除く）"""
+    names = []
+    for spec in package_info.get('info', {}).get('requires_dist') or []:
+        try:
+            requirement = Requirement(spec)
+        except InvalidRequirement:
+            continue
+        if requirement.marker is not None and not requirement.marker.evaluate({'extra': ''}):
+            continue
+        names.append(requirement.name)
+    return names
+
+def resolve_dependencies(executor, package_names):
+    """依存関係を辿ってパッケージ情報を取得（{パッケージ名: 情報}。同じパッケージは1回だけ取得）"""
+    package_infos = {}
+    visited = {canonicalize_name(name) for name in package_names}
+    frontier = list(package_names)
+    while frontier:
+        # 同じ深さのパッケージはまとめて並行取得
+        infos = fetch_package_infos(executor, frontier)
+        package_infos.update(infos)
+        frontier = []
+        for package_info in infos.values():
+            if not package_info:
+                continue
+            for name in get_requirements(package_info):
+                key = canonicalize_name(name)
+                if key not in visited:
+                    visited.add(key)
+                    frontier.append(name)
+    return package_infos
 
-def find_compatible_wheel(package_info, python_version, architecture):
+def get_latest_version(releases):
+    """ファイルのある最新の正式版を返す（文字列比較だと "9.0" > "10.0" になるため数値で比較）"""
+    candidates = []
+    for version, files in releases.items():
+        if not files:
+            continue
+        if PACKAGING_AVAILABLE:
+            try:
+                parsed = Version(version)
+            except InvalidVersion:
+                continue
+            if not parsed.is_prerelease:
+                candidates.append((parsed, version))
+        elif re.fullmatch(r"\d+(\.\d+)*", version):
+            candidates.append((tuple(int(n) for n in version.split(".")), version))
+    return max(candidates)[1] if candidates else None
+
+def is_compatible_wheel(filename):
+    """wheelファイルがこの環境にインストールできるか判定"""
+    if COMPATIBLE_TAGS is not None:
+        try:
+            _, _, _, tags = parse_wheel_filename(filename)
+        except InvalidWheelFilename:
+            return False
+        return not tags.isdisjoint(COMPATIBLE_TAGS)
+    # packaging がない場合はファイル名で簡易判定（純Python か、CPythonバージョン／abi3 とアーキテクチャが一致）
+    if filename.endswith("-none-any.whl"):
+        return True
+    if ARCHITECTURE not in filename:
+        return False
+    return PYTHON_TAG in filename or "-abi3-" in filename
+
+def find_compatible_wheel(package_info):
     """互換性のあるwheelファイルを検索"""
     if not package_info:
         return None
@@ -57,21 +247,21 @@ def find_compatible_wheel(package_info, python_version, architecture):
     releases = package_info.get('releases', {})
     
     # 最新バージョンを取得
-    latest_version = max(releases.keys())
+    latest_version = get_latest_version(releases)
+    if latest_version is None:
+        return None
     files = releases[latest_version]
     
     # wheelファイルを検索
     for file_info in files:
         filename = file_info['filename']
-        if filename.endswith('.whl'):
-            # Pythonバージョンとアーキテクチャをチェック
-            if f"cp{python_version.replace('.', '')}" in filename:
-                if architecture in filename or "any" in filename:
-                    return {
-                        'filename': filename,
-                        'url': file_info['url'],
-                        'version': latest_version
-                    }
+        if filename.endswith('.whl') and not file_info.get('yanked'):
+            if is_compatible_wheel(filename):
+                return {
+                    'filename': filename,
+                    'url': file_info['url'],
+                    'version': latest_version
+                }
     
     return None
 
@@ -80,12 +270,8 @@ def download_packages():
     print("🚀 オフラインインストール用パッケージダウンロード")
     print("=" * 60)
     
-    # システム情報を取得
-    python_version = get_python_version()
-    architecture = get_architecture()
-    
-    print(f"🐍 Python バージョン: {python_version}")
-    print(f"🏗️  アーキテクチャ: {architecture}")
+    print(f"🐍 Python バージョン: {PYTHON_VERSION}")
+    print(f"🏗️  アーキテクチャ: {ARCHITECTURE}")
     
     # ダウンロードディレクトリを作成
     download_dir = Path("packages")
@@ -97,35 +283,49 @@ def download_packages():
         "opencv-python",
         "picamera2",
         "numpy",
-        "Pillow"
+        "Pillow",
+        "pyserial",
+        # 本番用WSGIサーバー（無いと app.py は開発サーバーで起動してしまう）
+        "waitress",
+        # 高速JSONシリアライザ（任意。無ければ標準の json を使用）
+        "orjson",
+        # libjpeg-turbo 直接呼び出し（任意。システムの libturbojpeg0 も必要）
+        "PyTurboJPEG"
     ]
     
-    # 依存関係パッケージ
-    dependencies = [
-        "Werkzeug",
-        "Jinja2",
-        "MarkupSafe",
-        "itsdangerous",
-        "click",
-        "blinker"
-    ]
+    downloaded_count = 0
+    failed_packages = []
+    downloads = []  # (パッケージ名, URL, 保存先)
     
-    all_packages = packages + dependencies
+    # パッケージ情報は全件まとめて並行取得（待ち時間が合計ではなく最大の1回分になる）
+    print("\n🔍 パッケージ情報を取得中...")
+    # 情報取得とダウンロードで同じワーカースレッドを使い、keep-alive 接続を使い回す
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    if PACKAGING_AVAILABLE:
+        # PyPI の requires_dist から依存関係を辿り、重複なく全パッケージを集める
+        package_infos = resolve_dependencies(executor, packages)
+    else:
+        # packaging がない場合は既知の依存関係パッケージを固定で追加
+        dependencies = [
+            "Werkzeug",
+            "Jinja2",
+            "MarkupSafe",
+            "itsdangerous",
+            "click",
+            "blinker"
+        ]
+        package_infos = fetch_package_infos(executor, packages + dependencies)
+    all_packages = list(package_infos)
     
     print(f"\n📦 {len(all_packages)}個のパッケージをダウンロードします")
     
-    downloaded_count = 0
-    failed_packages = []
-    
     for package in all_packages:
-        print(f"\n🔍 {package} の情報を取得中...")
-        
-        package_info = get_package_info(package)
+        package_info = package_infos[package]
         if not package_info:
             failed_packages.append(package)
             continue
         
-        wheel_info = find_compatible_wheel(package_info, python_version, architecture)
+        wheel_info = find_compatible_wheel(package_info)
         if not wheel_info:
             print(f"⚠️  {package} の互換性のあるwheelファイルが見つかりません")
             failed_packages.append(package)
@@ -138,12 +338,16 @@ def download_packages():
         print(f"📋 パッケージ: {package} {version}")
         print(f"📁 ファイル: {filename}")
         
-        filepath = download_dir / filename
-        
-        if download_file(url, filepath):
+        downloads.append((package, url, download_dir / filename))
+    
+    # wheel のダウンロードも並行して実行（同時数は PyPI に配慮して控えめに）
+    results = executor.map(lambda d: download_file(d[1], d[2]), downloads)
+    for (package, _, _), success in zip(downloads, results):
+        if success:
             downloaded_count += 1
         else:
             failed_packages.append(package)
+    executor.shutdown()
     
     # 結果表示
     print(f"\n📊 ダウンロード結果:")
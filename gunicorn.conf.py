@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn 設定（本番用）
+
+起動方法:
+    gunicorn -c gunicorn.conf.py app:app
+"""
+
+bind = "0.0.0.0:5000"
+
+# カメラとシリアルポートは1プロセスでしか開けないためワーカーは1つに固定
+workers = 1
+
+# gevent はモンキーパッチによりカメラ取得スレッドやシリアルの blocking read を
+# グリーンレット化してイベントループを止めてしまうため、スレッドワーカーを使用する
+worker_class = "gthread"
+threads = 16
+
+# 開発サーバー（app.run）と異なり __main__ ブロックは実行されないため、
+# ワーカー起動後にカメラとシリアル通信を初期化する
+def post_worker_init(worker):
+    import app
+    app.initialize_hardware()
@@ -10,12 +10,17 @@ import subprocess
 import platform
 import shutil
 import glob
+import re
+from collections import defaultdict
+from pathlib import Path
 
 def run_command(command, description):
     """コマンドを実行"""
     print(f"\n🔧 {description}...")
     try:
-        result = subprocess.run(command, shell=True, check=True, capture_output=True, text=True)
+        # 引数リストで渡された場合はシェルを経由せずに実行
+        result = subprocess.run(command, shell=isinstance(command, str), check=True,
+                                capture_output=True, text=True)
         print(f"✅ {description} 完了")
         return True
     except subprocess.CalledProcessError as e:
@@ -40,8 +45,8 @@ def check_system():
     print(f"✅ Python {python_version.major}.{python_version.minor}.{python_version.micro}")
     return True
 
-def find_usb_packages():
-    """USBメモリからパッケージを検索"""
+def find_usb_packages(allow_sdist=False):
+    """USBメモリからパッケージを検索（allow_sdist=False なら wheel のみ）"""
     print("\n🔍 USBメモリからパッケージを検索中...")
     
     # 一般的なUSBマウントポイントをチェック
@@ -52,22 +57,30 @@ def find_usb_packages():
         "/mnt/*"
     ]
     
+    # sdist（.tar.gz / .zip）はラズパイ上でのビルドに数分以上かかるため、指定時のみ対象にする
+    package_exts = ('.whl', '.tar.gz', '.zip') if allow_sdist else '.whl'
     package_paths = []
+    # /media/pi/* と /media/* のように重なる検索先は一度だけ走査する
+    searched = set()
     for path_pattern in usb_paths:
         try:
             for path in glob.glob(path_pattern):
-                if os.path.isdir(path):
+                if os.path.isdir(path) and path not in searched:
                     print(f"📁 検索中: {path}")
-                    # Pythonパッケージファイルを検索
-                    for ext in ['*.whl', '*.tar.gz', '*.zip']:
-                        package_paths.extend(glob.glob(os.path.join(path, '**', ext), recursive=True))
+                    # Pythonパッケージファイルを1回の走査で全拡張子まとめて検索
+                    for root, dirs, files in os.walk(path):
+                        searched.add(root)
+                        dirs[:] = [d for d in dirs if os.path.join(root, d) not in searched]
+                        for name in files:
+                            if name.endswith(package_exts):
+                                package_paths.append(Path(root, name))
         except Exception as e:
             print(f"⚠️  {path_pattern} の検索中にエラー: {e}")
     
     if package_paths:
         print(f"✅ {len(package_paths)}個のパッケージファイルが見つかりました")
         for pkg in package_paths[:5]:  # 最初の5個を表示
-            print(f"   📦 {os.path.basename(pkg)}")
+            print(f"   📦 {pkg.name}")
         if len(package_paths) > 5:
             print(f"   ... 他 {len(package_paths) - 5}個")
     else:
@@ -75,6 +88,34 @@ def find_usb_packages():
     
     return package_paths
 
+def canonicalize_name(name):
+    """パッケージ名を正規化（PEP 503: 大文字小文字と - _ . の違いを無視）"""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+def parse_package_filename(filename):
+    """パッケージファイル名から (正規化したパッケージ名, バージョン) を返す（解析できなければ None）"""
+    if filename.endswith('.whl'):
+        # wheel: {name}-{version}(-{build})?-{python}-{abi}-{platform}.whl
+        parts = filename[:-len('.whl')].split('-')
+        if len(parts) < 5:
+            return None
+        name, version = parts[0], parts[1]
+    else:
+        # sdist: {name}-{version}.tar.gz / .zip
+        for ext in ('.tar.gz', '.zip'):
+            if filename.endswith(ext):
+                name, sep, version = filename[:-len(ext)].rpartition('-')
+                break
+        else:
+            return None
+        if not sep:
+            return None
+    return canonicalize_name(name), version
+
+def version_key(version):
+    """バージョンの比較キー（文字列比較だと "9.0" > "10.0" になるため数値で比較）"""
+    return tuple(int(n) if n.isdigit() else -1 for n in re.split(r"[.+!-]", version))
+
 def install_system_dependencies_offline():
     """オフラインでシステム依存関係をインストール"""
     print("\n📦 システム依存関係をインストール中（オフライン）...")
@@ -87,21 +128,40 @@ def install_system_dependencies_offline():
     ]
     
     # オフラインで利用可能なパッケージをチェック
+    # インストール済みパッケージ一覧は dpkg-query で1回だけ取得（パッケージ毎にシェルを起動しない）
+    installed = set()
+    try:
+        result = subprocess.run(["dpkg-query", "-W", "-f=${Package}\t${Status}\n"],
+                                capture_output=True, text=True)
+        for line in result.stdout.splitlines():
+            name, _, status = line.partition("\t")
+            if status.endswith(" installed"):
+                installed.add(name)
+    except Exception as e:
+        print(f"⚠️  インストール済みパッケージの確認に失敗: {e}")
+    
     available_packages = []
     for package in basic_packages:
-        try:
-            result = subprocess.run(f"dpkg -l | grep {package}", shell=True, capture_output=True, text=True)
-            if result.returncode == 0:
-                print(f"✅ {package} は既にインストールされています")
-            else:
-                available_packages.append(package)
-        except:
+        if package in installed:
+            print(f"✅ {package} は既にインストールされています")
+        else:
             available_packages.append(package)
     
     if available_packages:
         print(f"⚠️  以下のパッケージが利用できません: {', '.join(available_packages)}")
         print("   システムに事前にインストールされているか確認してください")
     
+    # 任意のパッケージ（無くても動作するが、あれば高速化に使う）
+    optional_packages = {
+        "libturbojpeg0": "PyTurboJPEG による高速JPEGエンコード（無ければ cv2.imencode）",
+    }
+    for package, purpose in optional_packages.items():
+        if package in installed:
+            print(f"✅ {package} は既にインストールされています")
+        else:
+            print(f"ℹ️  {package} がありません: {purpose}")
+            print(f"   オンライン時: sudo apt install -y {package} / オフライン時: .deb を sudo dpkg -i でインストール")
+    
     return True
 
 def setup_virtual_environment():
@@ -134,39 +194,66 @@ def install_python_dependencies_offline(package_paths):
         "opencv-python",
         "picamera2",
         "numpy",
-        "Pillow"
+        "Pillow",
+        "pyserial",
+        # 本番用WSGIサーバー（無いと app.py は開発サーバーで起動してしまう）
+        "waitress",
+        # 高速JSONシリアライザ（任意。無ければ標準の json を使用）
+        "orjson",
+        # libjpeg-turbo 直接呼び出し（任意。システムの libturbojpeg0 も必要）
+        "PyTurboJPEG"
     ]
     
-    # USBメモリからパッケージをインストール
-    installed_count = 0
+    # ファイル名を1回だけ解析し、正規化したパッケージ名で引けるようにする
+    # （部分一致だと "pillow" が pillow_heif-*.whl にも一致してしまう）
+    packages_by_name = defaultdict(list)
+    for pkg_path in package_paths:
+        parsed = parse_package_filename(pkg_path.name)
+        if parsed:
+            name, version = parsed
+            packages_by_name[name].append((version_key(version), pkg_path))
+    
+    # USBメモリから各パッケージのファイルを選ぶ
+    selected_packages = []
     for package in required_packages:
         print(f"\n🔍 {package} を検索中...")
         
-        # パッケージ名に基づいてファイルを検索
-        found_packages = []
-        for pkg_path in package_paths:
-            pkg_name = os.path.basename(pkg_path).lower()
-            if package.lower().replace('-', '_') in pkg_name:
-                found_packages.append(pkg_path)
-        
+        found_packages = packages_by_name.get(canonicalize_name(package))
         if found_packages:
-            # 最新のパッケージを選択（ファイル名に日付やバージョンが含まれている場合）
-            selected_pkg = sorted(found_packages)[-1]
-            print(f"📦 インストール: {os.path.basename(selected_pkg)}")
-            
-            if run_command(f"venv/bin/pip install {selected_pkg}", f"{package} インストール"):
-                installed_count += 1
+            # 最新バージョンのファイルを選択
+            selected_pkg = max(found_packages)[1]
+            print(f"📦 インストール対象: {selected_pkg.name}")
+            selected_packages.append(selected_pkg)
         else:
             print(f"⚠️  {package} のパッケージファイルが見つかりませんでした")
             print(f"   手動で {package} のパッケージファイルをUSBメモリに配置してください")
     
+    # pip は1回だけ起動してまとめてインストール（起動と依存関係の解決が1回で済む）
+    # PyPI には接続せず、依存パッケージも USB メモリ上のファイルから探す
+    installed_count = 0
+    if selected_packages:
+        find_links = []
+        for pkg_dir in dict.fromkeys(pkg_path.parent for pkg_path in package_paths):
+            find_links += ["--find-links", str(pkg_dir)]
+        command = ["venv/bin/pip", "install", "--no-index", *find_links, *map(str, selected_packages)]
+        if run_command(command, "パッケージ一括インストール"):
+            installed_count = len(selected_packages)
+        else:
+            # 一括インストールは1つでも依存関係が欠けると全体が失敗するため、
+            # 1ファイルずつ入れ直して入れられるものだけでもインストールする
+            print("⚠️  一括インストールに失敗したため、1パッケージずつインストールします")
+            for pkg_path in selected_packages:
+                command = ["venv/bin/pip", "install", "--no-index", *find_links, str(pkg_path)]
+                if run_command(command, f"{pkg_path.name} インストール"):
+                    installed_count += 1
+    
     print(f"\n📊 インストール結果: {installed_count}/{len(required_packages)} パッケージ")
     
     if installed_count < len(required_packages):
         print("\n⚠️  一部のパッケージがインストールできませんでした")
         print("以下のパッケージファイルをUSBメモリに配置してください:")
         for package in required_packages:
-            print(f"   - {package} (.whl または .tar.gz)")
+            print(f"   - {package} (.whl。.tar.gz は --allow-sdist 指定時のみ)")
     
     return installed_count > 0
 
@@ -190,6 +277,18 @@ picamera2==0.3.12
 # 数値計算
 numpy==1.24.3
 
+# シリアル通信（ポンプ制御）
+pyserial==3.5
+
+# 本番用WSGIサーバー（python app.py で使用）
+waitress==2.1.2
+
+# 高速JSONシリアライザ（任意。無くても動作する）
+orjson==3.9.10
+
+# libjpeg-turbo 直接呼び出し（任意。apt の libturbojpeg0 も必要。無ければ cv2.imencode）
+PyTurboJPEG==1.7.2
+
 # インストール方法:
 # 1. 上記パッケージの.whlファイルをUSBメモリに配置
 # 2. venv/bin/pip install /path/to/usb/package.whl
@@ -285,6 +384,27 @@ def create_offline_install_guide():
 - ファイル名例: Pillow-10.0.1-cp39-cp39-linux_aarch64.whl
 - ダウンロード: https://pypi.org/project/Pillow/#files
 
+### 6. pyserial (シリアル通信・ポンプ制御)
+- ファイル名例: pyserial-3.5-py2.py3-none-any.whl
+- ダウンロード: https://pypi.org/project/pyserial/#files
+
+### 7. waitress (本番用WSGIサーバー)
+- ファイル名例: waitress-2.1.2-py3-none-any.whl
+- ダウンロード: https://pypi.org/project/waitress/#files
+- 無い場合 app.py は開発サーバーで起動します（警告が表示されます）
+
+### 8. orjson (高速JSONシリアライザ・任意)
+- ファイル名例: orjson-3.9.10-cp39-cp39-manylinux_2_17_aarch64.manylinux2014_aarch64.whl
+- ダウンロード: https://pypi.org/project/orjson/#files
+- 無い場合は標準の json で応答します
+
+### 9. PyTurboJPEG (高速JPEGエンコード・任意)
+- ファイル名例: pyturbojpeg-2.5.0-py3-none-any.whl（1.7.2 など古い版は .tar.gz のみのため `python3 setup.py --allow-sdist` が必要）
+- ダウンロード: https://pypi.org/project/PyTurboJPEG/#files
+- システムライブラリ libturbojpeg0 も必要です（Raspberry Pi OS の apt パッケージ）
+  - オフライン環境では libturbojpeg0 の .deb を USB メモリに配置し `sudo dpkg -i libturbojpeg0_*.deb`
+- どちらか無い場合は cv2.imencode でエンコードします
+
 ## インストール手順
 
 1. USBメモリをラズパイに接続
@@ -360,7 +480,7 @@ def main():
         return False
     
     # USBメモリからパッケージを検索
-    package_paths = find_usb_packages()
+    package_paths = find_usb_packages(allow_sdist="--allow-sdist" in sys.argv)
     
     # システム依存関係インストール（オフライン）
     if not install_system_dependencies_offline():